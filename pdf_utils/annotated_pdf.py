@@ -6,20 +6,29 @@ with actual words, and provide tools for seeing these words in context.
 from __future__ import annotations
 
 import logging
-from collections import defaultdict
-from operator import itemgetter
+from itertools import count, repeat
 from pathlib import Path
-from typing import Callable, Dict, List, Optional, Union
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Union
 
+import numpy as np
 from PyPDF2 import PdfFileReader, PdfFileWriter
 from PyPDF2.generic import IndirectObject, NameObject, NumberObject
-from lxml import html
+from lxml import etree, html
 
 from pdf_utils.annotation import Annotation, AnnotationExtractor
-from pdf_utils.pdf_handler import Pdf
+from pdf_utils.converter import pdf_boxes_to_image_boxes
+from pdf_utils.pdf_handler import Pdf, WORDS_XPATH
+from pdf_utils.rectangle import Rectangle
+
+try:
+    import pikepdf  # optional, removes annotations by QPDF instead of cloning the document by PyPDF2
+except ImportError:
+    pikepdf = None
 
 logger = logging.getLogger(__name__)
 
+FLOWS_XPATH = etree.XPath(".//flow")
+
 
 class AnnotatedPdf(Pdf):
     """Tools to process one annotated pdf."""
@@ -33,23 +42,52 @@ class AnnotatedPdf(Pdf):
     def __init__(self, pdf_path: Union[str, Path]) -> None:
         super().__init__(pdf_path)
         self._raw_annotations = AnnotationExtractor().get_annot_from_pdf(self)
+        self.close()  # the pdf file is opened again only if PyPDF2 is needed later
         self._enriched_annotations = None
 
+        # html pages with their flows and words are collected on first use, see `_collect_flows`; users who need
+        # only the raw annotations do not run pdftotext at all
+        self._pages_as_html = None
+        self._page_words_cache = {}  # page_idx -> _PageWords, see `_page_words`
+        self._flow_texts = {}  # flow id -> words of the flow as strings, see `_flow_words_as_text`
+        self._neighborhoods = {}  # index of enriched annotation -> neighborhood, see `_neighborhood_of_annotation`
+
+    def _collect_flows(self) -> None:
+        """Collect html pages, their flows, and words of every flow and page (only on the first call)."""
+        if self._pages_as_html is not None:
+            return
         # list of all pages, as html element
-        self._pages_as_html = [self.get_page_as_html(page_idx).find(".//page")
-                               for page_idx in range(self.number_of_pages)]
-        self._page_to_page_idx = {page: page_idx for page_idx, page in enumerate(self._pages_as_html)}
+        self._pages_as_html = list(self._get_bbox_pages())
 
         # List of all flow, as they are in the html pages.
         # This should be the only place where we search in html, so that all flows are unique as objects
-        self._flows_as_html = sum([page.findall(".//flow") for page in self._pages_as_html], [])
-        self._flow_to_id = {flow: _id for _id, flow in enumerate(self._flows_as_html)}
+        # Flows of every page, and words of every flow and page, are collected by compiled XPaths (evaluated by libxml2)
+        # The collected lists are reused later instead of searching the html trees again.
+        # Flows are identified by their position in `_flows_as_html`; lists indexed by this flow id
+        # hold the page and the words of each flow, so that no lookups keyed by flow elements are needed.
+        self._flows_as_html, self._flow_to_page_idx, self._words_of_flow, self._words_of_page = [], [], [], []
+        self._word_location = {}  # word element -> (id of its flow, index of the word within the flow)
+        for page_idx, page in enumerate(self._pages_as_html):
+            for flow in FLOWS_XPATH(page):
+                flow_id, flow_words = len(self._flows_as_html), WORDS_XPATH(flow)
+                self._flows_as_html.append(flow)
+                self._flow_to_page_idx.append(page_idx)
+                self._words_of_flow.append(flow_words)
+                self._word_location.update(zip(flow_words, zip(repeat(flow_id), count())))
+            self._words_of_page.append(self._page_word_elements(page_idx))  # shared with `get_pages` of Pdf
+        self._number_of_words = sum(len(page_words) for page_words in self._words_of_page)
 
     @property
     def raw_annotations(self) -> List[Annotation]:
         """Extract annotations from pdf."""
         return self._raw_annotations
 
+    @property
+    def number_of_words(self) -> int:
+        """Count words in the digital layer of the pdf."""
+        self._collect_flows()
+        return self._number_of_words
+
     @property
     def enriched_annotations(self) -> List[Dict]:
         """Extract 'rectangle' annotations with matched words.
@@ -68,6 +106,23 @@ class AnnotatedPdf(Pdf):
             self._enriched_annotations = self._match_annotations_with_words()
         return self._enriched_annotations
 
+    def get_annotation_image_boxes(self,
+                                   page_idx: int,
+                                   img_size: Tuple[int, int]) -> Tuple[List[Annotation], np.ndarray]:
+        """Return raw annotations of one page, together with their bounding boxes in image coordinates.
+
+        All boxes of the page are converted in one call of converter.pdf_boxes_to_image_boxes.
+
+        :param page_idx: page number, starting from zero
+        :param img_size: (img_width, img_height) of the page image, e.g. `self.page_image(page_idx).size`
+        :return: list of annotations on the page and an integer array of shape (n_annotations, 4)
+            with columns x_min, y_min, x_max, y_max
+        """
+        annotations = [annot for annot in self._raw_annotations if annot.page == page_idx]
+        boxes = np.array([(annot.box.x_min, annot.box.y_min, annot.box.x_max, annot.box.y_max)
+                          for annot in annotations], dtype=np.float64).reshape(-1, 4)
+        return annotations, pdf_boxes_to_image_boxes(boxes, *self.get_width_height(page_idx), *img_size)
+
     def get_flows_with_annotations(self,
                                    transform_anno_text_description: Callable[[str], str] = lambda s: s
                                    ) -> Dict[int, Dict]:
@@ -100,38 +155,43 @@ class AnnotatedPdf(Pdf):
             }.
         """
         # check if digital content exists
-        nr_words = sum(len(v) for v in self.get_pages().values())
-        if nr_words < self.minimal_words_in_document:
+        if self.number_of_words < self.minimal_words_in_document:
             logger.warning("Cannot extract digital content from pdf (no words there).")
             return {}
 
         # create flows with words, but no annotations yet
         annotated_flows = self._initialize_flows()
+        if not any(annot.type in self._enrich_annotation_types for annot in self.raw_annotations):
+            # nothing to match, the flows stay without annotations
+            return annotated_flows
 
         # iterate over annotations whose types are within self.match_annotation_types
-        for annot in self.enriched_annotations:
+        for annot_idx, annot in enumerate(self.enriched_annotations):
             if not annot["words"]:
                 logger.warning(f"annotation {annot} found with no words")
                 continue
 
-            # create a list of html-elements representing annotated words
-            words = [w["word"] for w in annot["words"]]
-            # neighborhood of some words is a dict with keys 'flow', 'words', 'indices'
-            neighborhood = self._get_neighborhood_of_words(words)
+            # neighborhood of annotated words is a dict with keys 'flow', 'words', 'indices'
+            neighborhood = self._neighborhood_of_annotation(annot_idx)
             if neighborhood is None:
-                logger.warning(f"cannot get ancestor flow for the words {[w.text for w in words]} "
+                logger.warning(f"cannot get ancestor flow for the words {[w['word'].text for w in annot['words']]} "
                                f"(file {self.pdf_path}, skipping")
                 continue
             # here we find in which flow the annotation is
-            current_flow_id = self._flow_to_id[neighborhood["flow"]]
+            current_flow_id = neighborhood["flow_id"]
             annot_text_content = annot["annotation"].text_content
             if not annot_text_content:
                 logger.warning(f"rectangle annotation with empty text_content found, annot={annot['annotation']}")
                 continue
             # normalize annotation's text_content
             annot_description = transform_anno_text_description(annot_text_content)
-            # we add indices of annotated words into the annot_description
-            annotated_flows[current_flow_id]["annotated_indices"][annot_description] += neighborhood["indices"]
+            # we add indices of annotated words into the annot_description;
+            # extending in place keeps merging linear in the number of indices
+            annotated_indices = annotated_flows[current_flow_id]["annotated_indices"]
+            if annot_description in annotated_indices:
+                annotated_indices[annot_description].extend(neighborhood["indices"])
+            else:
+                annotated_indices[annot_description] = list(neighborhood["indices"])
 
         return annotated_flows
 
@@ -140,38 +200,80 @@ class AnnotatedPdf(Pdf):
 
         This is the backend of the `enriched_annotations` method.
         """
-        pages = self._pages_as_html
+        annotations_by_page = AnnotationExtractor._group_by_pages(
+            [annot for annot in self.raw_annotations if annot.type in self._enrich_annotation_types])
         matched_annotations = []
-        for annot in self.raw_annotations:
-            if annot.type in self._enrich_annotation_types:
+        for page_idx, page_annotations in annotations_by_page.items():
+            page_words = self._page_words(page_idx)
+            # only words whose boxes intersect some annotation box are scored, the others would score 0
+            candidates = np.unique(np.concatenate([page_words.index.query(annot.box) for annot in page_annotations]))
+            candidate_words = [page_words.words[i] for i in candidates.tolist()]
+            candidate_boxes = page_words.boxes[candidates]
+            # scores of all annotations on the page against all candidate words, in one broadcast
+            scores = self._get_scored_words(
+                candidate_boxes,
+                page_words.inverse_areas[candidates],
+                np.array([(a.box.x_min, a.box.y_min, a.box.x_max, a.box.y_max) for a in page_annotations],
+                         dtype=np.float64))
+            for annot, annot_scores in zip(page_annotations, scores):
                 matched_annotations.append({
                     "annotation": annot,
                     "words": self._find_words_related_to_one_annotation(
-                        annot,
-                        pages[annot.page].findall(".//word"))})
+                        annot, candidate_words, candidate_boxes, annot_scores)})
         return matched_annotations
 
+    def _page_words(self, page_idx: int) -> _PageWords:
+        """Return words on a page together with their bounding boxes, inverse areas and spatial index.
+
+        Boxes are parsed from the html attributes once per page, straight into an array of shape (n_words, 4)
+        with columns x_min, y_min, x_max, y_max. Double precision keeps the scores equal to the ones computed
+        with Rectangles (up to rounding in the last bit, by multiplying with the inverse area instead of dividing),
+        so that words scoring right at the matching thresholds are matched the same way.
+        """
+        if page_idx not in self._page_words_cache:
+            self._collect_flows()
+            words = self._words_of_page[page_idx]
+            boxes = Pdf.get_bounding_boxes_of_elems(words, dtype=np.float64)
+            areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+            # scores are divided by areas of words; the reciprocals are taken once per page, and scoring multiplies
+            inverse_areas = np.divide(1.0, areas, out=np.zeros_like(areas), where=areas > 0)
+            self._page_words_cache[page_idx] = _PageWords(
+                words=words,
+                boxes=boxes,
+                inverse_areas=inverse_areas,
+                index=_SweepIndex(boxes))
+        return self._page_words_cache[page_idx]
+
     def _find_words_related_to_one_annotation(self,
                                               annotation: Annotation,
-                                              words_in_page: List[html.HtmlElement]) -> List[Dict]:
+                                              words_in_page: List[html.HtmlElement],
+                                              word_boxes: np.ndarray,
+                                              scores: np.ndarray) -> List[Dict]:
         """Find words with high overlap with bounding box of a given annotation.
 
         :param annotation: one Annotation object
         :param words_in_page: list of html elements representing words on a pdf page
+        :param word_boxes: array of shape (n_words, 4) with bounding boxes of the words (see `_page_words`)
+        :param scores: proportions of the word boxes intersecting the annotation box (see `_get_scored_words`)
         :return: list of dictionaries of type
             {
                 "word": html element representing the word,
+                "bounding_box": bounding box of the word, as a Rectangle,
                 "score": proportion of the word box intersecting the annotation box
             }
         """
-        words = self._get_scored_words(words_in_page, annotation, self._match_words_threshold)
-        if words:
-            return words
-
-        # we didn't succeed, let's refine our search
-        words = self._get_scored_words(words_in_page, annotation, self._match_words_minimal_threshold)
-        if words:
-            best_word = max(words, key=itemgetter("score"))  # let's take the largest one
+        # candidates above the lower threshold, strong matches are selected among them
+        indices = np.flatnonzero(scores > self._match_words_minimal_threshold)
+        scores = scores[indices]
+        strong = scores > self._match_words_threshold
+        if strong.any():
+            return self._scored_words_as_dicts(words_in_page, word_boxes, indices[strong], scores[strong])
+
+        # we didn't succeed, let's take the best of the weak matches
+        if indices.size:
+            best = int(np.argmax(scores))  # let's take the largest one
+            best_word = self._scored_words_as_dicts(
+                words_in_page, word_boxes, indices[best:best + 1], scores[best:best + 1])[0]
             logger.warning(
                 f"Only weak annotation-word match. We are returning the word with largest overlap "
                 f"('{best_word['word']}', score = {best_word['score']})")
@@ -181,40 +283,83 @@ class AnnotatedPdf(Pdf):
         logger.warning(f"cannot match annotation {annotation} with any word-element (file {self.pdf_path.stem})")
         return []
 
+    def _flow_words_as_text(self, flow_id: int) -> List[str]:
+        """Return words of the flow as strings, computed once per flow (do not modify the returned list)."""
+        if flow_id not in self._flow_texts:
+            self._collect_flows()
+            self._flow_texts[flow_id] = [word.text for word in self._words_of_flow[flow_id]]
+        return self._flow_texts[flow_id]
+
+    def _neighborhood_of_annotation(self, annot_idx: int) -> Optional[Dict]:
+        """Return the neighborhood of words matched with the given enriched annotation.
+
+        Neighborhoods depend only on the enriched annotations, so they are computed once and reused
+        by every call of `get_flows_with_annotations`.
+        """
+        if annot_idx not in self._neighborhoods:
+            words = [w["word"] for w in self.enriched_annotations[annot_idx]["words"]]
+            self._neighborhoods[annot_idx] = self._get_neighborhood_of_words(words)
+        return self._neighborhoods[annot_idx]
+
     def _initialize_flows(self) -> Dict[int, Dict]:
         """Create a dictionary from flow_id to information about words in this flow."""
+        self._collect_flows()
         flows = {}
-        for flow in self._flows_as_html:
-            flow_id = self._flow_to_id[flow]
-            parent_page = flow.getparent()
+        for flow_id, page_idx in enumerate(self._flow_to_page_idx):
             flows[flow_id] = {
-                "words": [w.text for w in flow.findall(".//word")],
-                "page": self._page_to_page_idx[parent_page],
-                "annotated_indices": defaultdict(list)}
+                "words": list(self._flow_words_as_text(flow_id)),
+                "page": page_idx,
+                "annotated_indices": {}}  # most flows stay unannotated, keep them with a plain empty dict
         return flows
 
     @staticmethod
-    def _get_scored_words(words_in_page: List[html.HtmlElement],
-                          one_annotation: Annotation,
-                          threshold: float) -> List[Dict]:
-        """For one page and a given annotation, find all words that has high overlap with annotation's bounding box.
+    def _get_scored_words(word_coordinates: np.ndarray,
+                          word_inverse_areas: np.ndarray,
+                          annotation_coordinates: np.ndarray) -> np.ndarray:
+        """Score overlaps of all words with all annotations on a page.
+
+        The score of a word is the proportion of the word box intersecting the annotation box;
+        words with empty boxes get score 0.
+
+        :param word_coordinates: array of shape (n_words, 4) with columns x_min, y_min, x_max, y_max
+        :param word_inverse_areas: array of shape (n_words,) with 1 / area of the word boxes (0 for empty boxes)
+        :param annotation_coordinates: array of shape (n_annotations, 4), same columns as word_coordinates
+        :return: array of scores, of shape (n_annotations, n_words)
+        """
+        # the (n_annotations, n_words) intermediate results are computed in place in two reused buffers
+        words, annots = word_coordinates.T, annotation_coordinates.T[:, :, np.newaxis]
+        overlap = np.minimum(words[2], annots[2])
+        buffer = np.maximum(words[0], annots[0])
+        overlap -= buffer
+        np.maximum(overlap, 0, out=overlap)  # width of the intersection
+        np.minimum(words[3], annots[3], out=buffer)
+        buffer -= np.maximum(words[1], annots[1])
+        np.maximum(buffer, 0, out=buffer)  # height of the intersection
+        overlap *= buffer
+        # empty word boxes have zero inverse area, which keeps their score 0
+        overlap *= word_inverse_areas
+        return overlap
 
-        Return a list of potential word-candidates with form
+    @staticmethod
+    def _scored_words_as_dicts(words_in_page: List[html.HtmlElement],
+                               word_boxes: np.ndarray,
+                               indices: np.ndarray,
+                               scores: np.ndarray) -> List[Dict]:
+        """Convert selected words into dictionaries.
+
+        Rectangles are built from the word boxes parsed once per page (in double precision, as the html attributes),
+        so the attributes of the words are not parsed again for every matching annotation.
+        Return a list with form
         [{
             "word": html element representing the word,
+            "bounding_box": bounding box of the word, as a Rectangle,
             "score": proportion of the word box intersecting the annotation box
         ...,]
         """
-        scored_words = []
-        for word in words_in_page:
-            word_box = Pdf.get_bounding_box_of_elem(word)
-            annotation_and_box_interection = word_box.intersection(one_annotation.box)
-            score = 0 if annotation_and_box_interection is None else annotation_and_box_interection.area / word_box.area
-            if score > threshold:
-                scored_words.append({
-                    "word": word,
-                    "score": score})
-        return scored_words
+        return [{"word": words_in_page[i],
+                 "bounding_box": Rectangle(*box),
+                 "score": score}
+                for i, box, score in zip(indices.tolist(), word_boxes[indices].tolist(), scores.tolist())]
 
     def _get_neighborhood_of_words(self, words: List[html.HtmlElement]) -> Optional[Dict]:
         """For a list of given words, compute the corresponding section and indices of these words within section.
@@ -225,31 +370,35 @@ class AnnotatedPdf(Pdf):
         :param words: list of words, represented as html-elements
         :return: a dictionary with form
            'flow': flow as a html-element
+           'flow_id': index of the flow among all flows of the document
            'words': list of words in the flow (as strings)
            'indices': list of indices of the words that are within annotated_words.
         """
         assert words, f"no annotated_words, cannot create neighborhood ({self.pdf_path})"
 
-        # grand-grand-parents of a word is a flow
-        parents = [w.getparent().getparent().getparent() for w in words]
-        if not len(set(parents)) == 1:
-            logger.warning(f"words in the annotation are in different flows, cannot fetch neighborhood "
-                           f"(file {self.pdf_path}) -- skipping")
-            return None
-
-        ancestor = parents[0]
-        annotated_indices, words_in_section = [], []
-        for i, word in enumerate(ancestor.findall(".//word")):
-            words_in_section.append(word.text)
-            if word in words:
-                annotated_indices.append(i)
-
-        # checks if annotated words follow subsequently
-        if not annotated_indices == list(range(min(annotated_indices), max(annotated_indices) + 1)):
+        # flow and position of every word are known from `_collect_flows`, no need to scan the flow
+        self._collect_flows()
+        ancestor_id, _ = self._word_location.get(words[0], (None, None))
+        positions = set()
+        for word in words:
+            flow_id, position = self._word_location.get(word, (None, None))
+            if flow_id is None or flow_id != ancestor_id:  # stop at the first word from another flow
+                logger.warning(f"words in the annotation are in different flows, cannot fetch neighborhood "
+                               f"(file {self.pdf_path}) -- skipping")
+                return None
+            positions.add(position)
+
+        annotated_indices = sorted(positions)
+        words_in_section = list(self._flow_words_as_text(ancestor_id))
+
+        # checks if annotated words follow subsequently; the indices are sorted and unique, so comparing the span
+        # of the indices with their count is enough
+        if annotated_indices[-1] - annotated_indices[0] + 1 != len(annotated_indices):
             logger.warning(f"annotated words are not connected (file {self.pdf_path})")
 
         return {
-            "flow": ancestor,
+            "flow": self._flows_as_html[ancestor_id],
+            "flow_id": ancestor_id,
             "words": words_in_section,
             "indices": annotated_indices
         }
@@ -265,11 +414,63 @@ class AnnotatedPdf(Pdf):
         return pdf
 
     def remove_annotations_and_save(self, output_pdf_path: str) -> None:
-        """Get rid of annotations and store to a new pdf file."""
-        clean = self._clean_writer()
-        with open(output_pdf_path, "wb") as f:
-            logger.info(f"creating a new pdf {output_pdf_path}")
-            clean.write(f)
+        """Get rid of annotations and store to a new pdf file.
+
+        With pikepdf installed, the pdf is rewritten by QPDF; otherwise the whole document is cloned by PyPDF2.
+        """
+        logger.info(f"creating a new pdf {output_pdf_path}")
+        if pikepdf is not None:
+            with pikepdf.open(self.pdf_path) as pdf:
+                for page in pdf.pages:
+                    if "/Annots" in page:
+                        del page["/Annots"]
+                pdf.save(output_pdf_path)
+            return
+
+        try:
+            clean = self._clean_writer()
+            with open(output_pdf_path, "wb") as f:
+                clean.write(f)
+        finally:
+            self._close_reader()  # the cloned document reads from the file until it is written
+
+
+class _SweepIndex:
+    """Boxes sorted by their top edge, for finding boxes that intersect a query rectangle.
+
+    A box can intersect the query rectangle only if its top edge lies between the query's top edge minus
+    the largest box height and the query's bottom edge. This window of boxes (typically a few lines of text,
+    as words have similar heights) is found by two binary searches, and filtered by vectorized comparisons
+    of the other coordinates. Everything runs in numpy, no python loop over boxes.
+    """
+
+    # widens the window, so that rounding in computing its bounds never drops a touching box
+    _margin = 1e-6
+
+    def __init__(self, boxes: np.ndarray) -> None:
+        """Register boxes, given as an array of shape (n, 4) with columns x_min, y_min, x_max, y_max."""
+        self._order = np.argsort(boxes[:, 1], kind="stable")
+        self._sorted_boxes = boxes[self._order]
+        heights = boxes[:, 3] - boxes[:, 1]
+        self._max_height = max(float(heights.max()), 0.0) if len(boxes) else 0.0
+
+    def query(self, rect: Rectangle) -> np.ndarray:
+        """Return sorted indices of boxes intersecting `rect` (touching counts), as an integer array."""
+        tops = self._sorted_boxes[:, 1]
+        start = np.searchsorted(tops, rect.y_min - self._max_height - self._margin, side="left")
+        end = np.searchsorted(tops, rect.y_max, side="right")
+        window = self._sorted_boxes[start:end]
+        hits = (window[:, 3] >= rect.y_min) & (window[:, 0] <= rect.x_max) & (window[:, 2] >= rect.x_min)
+        return np.sort(self._order[start:end][hits])
+
+
+class _PageWords(NamedTuple):
+    """Words of one pdf page, with their geometry stored as arrays (one row per word) for vectorized scoring."""
+
+    words: List[html.HtmlElement]
+    boxes: np.ndarray  # shape (n_words, 4), columns x_min, y_min, x_max, y_max
+    inverse_areas: np.ndarray  # shape (n_words,), 1 / area of the word boxes, 0 for empty boxes
+    index: _SweepIndex
 
 
 class PdfFileWriterX(PdfFileWriter):
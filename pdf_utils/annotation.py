@@ -3,26 +3,55 @@ from __future__ import annotations
 
 import json
 import logging
+import multiprocessing
 import os
-from collections import defaultdict
-from typing import Any, Dict, List, Optional, Union
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, groupby
+from operator import attrgetter
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, TextIO, Union
+from weakref import WeakKeyDictionary
 
-from PyPDF2.generic import ByteStringObject, IndirectObject
+from PyPDF2.generic import ByteStringObject
 from PyPDF2.pdf import PageObject
 
 from pdf_utils.pdf_handler import CannotReadPdf, Pdf
 from pdf_utils.rectangle import Rectangle
 
+try:
+    import fitz  # PyMuPDF, optional faster backend for reading annotations
+except ImportError:
+    fitz = None
+
+try:
+    import orjson  # optional faster json serialization
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
 
 # change this if you want to include other annotations types from pdfs
 ADMISSIBLE_ANNOTATION_TYPES = {"rectangle", "oval", "ovál", "note"}
 
+# annotations already parsed by PyPDF2, as {pdf: {page_idx: [annotations on that page]}};
+# callers get copies of them (see `_copy_annotation`), entries disappear together with the Pdf objects
+_parsed_pages = WeakKeyDictionary()
+
+# the json module writes the same compact utf-8 json as orjson, except for NaN and infinite numbers
+# (orjson writes them as null, the json module as NaN and Infinity)
+_JSON_OPTIONS = {"ensure_ascii": False, "separators": (",", ":")}
+
+# output folders already known to exist, so that batch dumps don't stat the same folder for every file
+_existing_output_folders = set()
+
 
 class Annotation:
     """Data class representing one pdf-annotation."""
 
+    # no per-instance __dict__, documents and corpora can hold very many annotations
+    __slots__ = ("page", "type", "box", "text_content", "who_annotated", "label")
+
     def __init__(
             self,
             page: int,
@@ -61,7 +90,9 @@ class Annotation:
         }
 
     def __repr__(self) -> str:
-        return json.dumps(self.as_dict)
+        if orjson is not None:
+            return orjson.dumps(self.as_dict, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+        return json.dumps(self.as_dict, **_JSON_OPTIONS)
 
 
 class AnnotationExtractor:
@@ -70,24 +101,134 @@ class AnnotationExtractor:
     The main method is `get_annots_from_pdf`.
     """
 
+    # documents with fewer pages are parsed sequentially, process pool overhead would not pay off
+    parallel_min_pages = 32
+
     @staticmethod
-    def get_annot_from_pdf(pdf: Pdf) -> List[Annotation]:
+    def get_annot_from_pdf(pdf: Pdf, backend: str = "pypdf2", num_workers: Optional[int] = None) -> List[Annotation]:
         """Fetch annotations from annotated pdf and outputs as a list of annotation objects.
 
         :param pdf: Pdf object, representing a pdf file
+        :param backend: "pypdf2" (default) walks the pdf objects with PyPDF2,
+            "pymupdf" uses the much faster `get_annot_from_pdf_fitz` (requires PyMuPDF)
+        :param num_workers: number of processes parsing the pages with PyPDF2, used only for documents with
+            at least `parallel_min_pages` pages. By default min(cpu_count, 4) where processes are started by fork,
+            otherwise 1 (no worker processes). Where processes are spawned (Windows, macOS), the worker processes
+            import the main module again, so a script passing `num_workers` > 1 must guard its entry point
+            by `if __name__ == "__main__":`.
+        :return: List of Annotation objects, as found in the pdf document
+        """
+        if backend == "pymupdf":
+            return AnnotationExtractor.get_annot_from_pdf_fitz(pdf.pdf_path)
+        assert backend == "pypdf2", f"unknown backend: '{backend}'"
+
+        if num_workers is None:
+            # the first of all start methods is the platform default, used if none has been set
+            start_method = multiprocessing.get_start_method(allow_none=True)
+            if start_method is None:
+                start_method = multiprocessing.get_all_start_methods()[0]
+            num_workers = min(os.cpu_count() or 1, 4) if start_method == "fork" else 1
+        number_of_pages = pdf.number_of_pages
+        parsed = _parsed_pages.setdefault(pdf, {})
+        large_document = number_of_pages >= AnnotationExtractor.parallel_min_pages
+        if num_workers > 1 and large_document and len(parsed) < number_of_pages:
+            # each worker opens the pdf on its own and parses one contiguous range of pages
+            chunk_size = -(-number_of_pages // num_workers)
+            page_ranges = [range(start, min(start + chunk_size, number_of_pages))
+                           for start in range(0, number_of_pages, chunk_size)]
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                annotations = list(chain.from_iterable(
+                    executor.map(_read_annotations_from_pages, [pdf.pdf_path] * len(page_ranges), page_ranges)))
+            # pages memoized before are kept as they are, only the missing ones are filled in
+            missing = {idx: [] for idx in range(number_of_pages) if idx not in parsed}
+            for annot in annotations:
+                if annot.page in missing:
+                    missing[annot.page].append(annot)
+            parsed.update(missing)
+
+        return list(AnnotationExtractor.iter_annotations(pdf))
+
+    @staticmethod
+    def iter_annotations(pdf: Pdf) -> Iterator[Annotation]:
+        """Lazily yield annotations from annotated pdf, page by page (PyPDF2 backend).
+
+        Useful for large documents, where the consumer does not need all annotations in memory at once.
+        Parsed pages are memoized per Pdf object, so repeated requests (e.g. from AnnotatedPdf and from
+        the caller) do not walk the pdf objects again. Each request gets new Annotation objects,
+        so changing them (e.g. setting a label) does not affect other callers.
+        """
+        parsed = _parsed_pages.setdefault(pdf, {})
+        try:
+            for idx in range(pdf.number_of_pages):
+                if idx not in parsed:
+                    parsed[idx] = list(AnnotationExtractor._parse_annot_pdf_page(pdf.pdf_reader.getPage(idx), idx))
+                yield from map(_copy_annotation, parsed[idx])
+        finally:
+            pdf._close_reader()  # all pages are parsed (or the consumer stopped), the file is no longer needed
+
+    @staticmethod
+    def get_annot_from_pdf_fitz(pdf_path: Union[str, Path]) -> List[Annotation]:
+        """Fetch annotations from annotated pdf using PyMuPDF.
+
+        The annotations are read by MuPDF (C library) instead of traversing the pdf objects in python,
+        which is typically an order of magnitude faster than the PyPDF2 path.
+        Rectangles of annotations are already in coordinates increasing from above, relative to the page's cropBox.
+
+        :param pdf_path: path to a pdf file
         :return: List of Annotation objects, as found in the pdf document
         """
+        if fitz is None:
+            raise ImportError("PyMuPDF is not installed, cannot read annotations with fitz")
+
         outputs = []
-        for idx in range(pdf.number_of_pages):
-            outputs += AnnotationExtractor._parse_annot_pdf_page(pdf.pdf_reader.getPage(idx), idx)
+        with fitz.open(str(pdf_path)) as doc:
+            for page_idx, page in enumerate(doc):
+                for annot in page.annots():
+                    info = annot.info
+                    annot_type = info.get("subject", "").lower()
+                    if not annot_type:
+                        continue
+                    if annot_type not in ADMISSIBLE_ANNOTATION_TYPES:
+                        logger.warning(f"foreign annotation found (type {annot_type}, src {pdf_path})")
+                        continue
+                    rect = annot.rect
+                    outputs.append(Annotation(
+                        page=page_idx,
+                        type=annot_type,
+                        box=Rectangle(x_min=rect.x0, y_min=rect.y0, x_max=rect.x1, y_max=rect.y1),
+                        text_content=info.get("content") or None,
+                        who_annotated=info.get("title") or None))
         return outputs
 
     @staticmethod
-    def dump_annotations_to_file(annotations: List[Annotation], output_path: str) -> None:
-        """Json serialization of a list of Annotations."""
-        assert os.path.isdir(os.path.dirname(output_path)), f"folder {os.path.dirname(output_path)} doesn't exist."
-        with open(output_path, "w") as f:
-            json.dump([annot.as_dict for annot in annotations], f)
+    def dump_annotations_to_file(annotations: Iterable[Annotation], output_path: Union[str, TextIO]) -> None:
+        """Json serialization of a list of Annotations.
+
+        The json is compact and encoded in utf-8 (non-ascii text is not escaped). It is written by orjson,
+        if installed, otherwise by the json module; both give the same document, except for NaN and infinite
+        coordinates, which orjson writes as null, and the json module as NaN and Infinity.
+
+        :param annotations: annotations to serialize
+        :param output_path: path of the json file (its folder must exist), or an open text stream to write into
+        """
+        records = [annot.as_dict for annot in annotations]
+        if hasattr(output_path, "write"):
+            if orjson is not None:
+                output_path.write(orjson.dumps(records, option=orjson.OPT_SERIALIZE_NUMPY).decode())
+            else:
+                json.dump(records, output_path, **_JSON_OPTIONS)
+            return
+
+        output_folder = os.path.dirname(output_path)
+        if output_folder not in _existing_output_folders:
+            assert os.path.isdir(output_folder), f"folder {output_folder} doesn't exist."
+            _existing_output_folders.add(output_folder)
+        if orjson is not None:
+            with open(output_path, "wb") as f:
+                f.write(orjson.dumps(records, option=orjson.OPT_SERIALIZE_NUMPY))
+        else:
+            with open(output_path, "w", encoding="utf-8") as f:
+                json.dump(records, f, **_JSON_OPTIONS)
 
     @staticmethod
     def _create_annotations_bounding_box(box_as_list: List,
@@ -111,49 +252,68 @@ class AnnotationExtractor:
             y_max=float(page_height) - float(box_as_list[1]) if from_above else float(box_as_list[3]))
 
     @staticmethod
-    def _parse_annot_pdf_page(page: PageObject, page_idx: int) -> List[Annotation]:
-        """Fetch annotations on this pdf page and return them as a list."""
-        outputs = []
-        if not (page.cropBox[0] == page.cropBox[1] == 0):
+    def _parse_annot_pdf_page(page: PageObject, page_idx: int) -> Iterator[Annotation]:
+        """Fetch annotations on this pdf page and yield them one by one."""
+        crop_box = page.cropBox  # PyPDF2 rebuilds the RectangleObject on every attribute access
+        if not (crop_box[0] == crop_box[1] == 0):
             raise CannotReadPdf(
-                f"cannot find positions of annotations, cropBox of page does not start with zeros (={page.cropBox})")
+                f"cannot find positions of annotations, cropBox of page does not start with zeros (={crop_box})")
 
-        page_height = page.cropBox[3]  # assuming the mediabox has form [0,0,width,height]
+        page_height = crop_box[3]  # assuming the mediabox has form [0,0,width,height]
         annots = page.get('/Annots', [])
+        try:
+            annots = annots.getObject()  # resolves IndirectObject, no-op on arrays
+        except AttributeError:
+            pass
         if not isinstance(annots, list):
             # something is strange
-            if not isinstance(annots, IndirectObject):
-                logger.warning(f"cannot read annotations from {input}")
-                return []
-            annots = annots.getObject()  # now let's hope to get a list; in some cases this helps
-            if not isinstance(annots, list):
-                logger.warning(f"cannot read annotations from {input}")
-                return []
+            logger.warning(f"cannot read annotations from page {page_idx}")
+            return
+
+        admissible_types = ADMISSIBLE_ANNOTATION_TYPES  # local name for the lookups in the loop, read on each call
         for ann in annots:
             current = ann.getObject()
-            if "/Subj" in current:
-                annot_type = current["/Subj"].lower()
-                current_rec = AnnotationExtractor._create_annotations_bounding_box(current.get("/Rect"), page_height)
-                text_content = current.get("/Contents")
-                who_annotated = current.get("/T")
-                if isinstance(text_content, ByteStringObject):
-                    text_content = text_content.decode('utf-8')
-                if annot_type in ADMISSIBLE_ANNOTATION_TYPES:
-                    outputs.append(Annotation(
-                        page=page_idx,
-                        type=annot_type,
-                        box=current_rec,
-                        text_content=text_content,
-                        who_annotated=who_annotated))
-                else:
-                    logger.warning(f"foreign annotation found (type {annot_type}, src {input})")
-        return outputs
+            if "/Subj" not in current:
+                continue
+            annot_type = current["/Subj"].lower()
+            if annot_type not in admissible_types:
+                # rejected before any further object access (box, decoding of contents)
+                logger.warning(f"foreign annotation found (type {annot_type}, page {page_idx})")
+                continue
+            text_content = current.get("/Contents")
+            if isinstance(text_content, ByteStringObject):
+                text_content = text_content.decode('utf-8')
+            yield Annotation(
+                page=page_idx,
+                type=annot_type,
+                box=AnnotationExtractor._create_annotations_bounding_box(current.get("/Rect"), page_height),
+                text_content=text_content,
+                who_annotated=current.get("/T"))
 
     @staticmethod
     def _group_by_pages(records: List[Annotation]) -> Dict[int, List[Annotation]]:
         """Transform the records to a dictionary {page_nr: [records on that page]}."""
-        result = defaultdict(list)
-        for record in records:
-            page_num = record.page
-            result[page_num].append(record)
-        return dict(result)
+        page_of = attrgetter("page")
+        pages = [record.page for record in records]
+        if any(previous > current for previous, current in zip(pages, pages[1:])):
+            # extracted annotations come in page order, so sorting is needed only for records from elsewhere
+            records = sorted(records, key=page_of)
+        return {page_num: list(group) for page_num, group in groupby(records, key=page_of)}
+
+
+def _copy_annotation(annot: Annotation) -> Annotation:
+    """Copy of a memoized annotation, including its box, without validating the already validated data again."""
+    copy = Annotation.__new__(Annotation)
+    copy.page, copy.type, copy.text_content, copy.who_annotated, copy.label = (
+        annot.page, annot.type, annot.text_content, annot.who_annotated, annot.label)
+    box = annot.box
+    copy.box = Rectangle._from_valid(box.x_min, box.y_min, box.x_max, box.y_max)
+    return copy
+
+
+def _read_annotations_from_pages(pdf_path: Path, page_indices: range) -> List[Annotation]:
+    """Parse annotations on the given pages of a pdf; runs in a worker process of `get_annot_from_pdf`."""
+    with Pdf(pdf_path) as pdf:
+        return [annot
+                for idx in page_indices
+                for annot in AnnotationExtractor._parse_annot_pdf_page(pdf.pdf_reader.getPage(idx), idx)]
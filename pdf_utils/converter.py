@@ -1,13 +1,27 @@
 """Various basic tools for conversions between pdf's, text, images and words and word indices."""
-import subprocess
-from typing import Dict, List, Tuple, Union
+import os
+from contextlib import ExitStack
+from io import BytesIO
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import pdf2image
 from PIL import Image
+from PyPDF2 import PdfFileReader, PdfFileWriter
 
 from pdf_utils.rectangle import Rectangle
 
+try:
+    import fitz  # PyMuPDF, optional in-process renderer of pdf pages
+except ImportError:
+    fitz = None
+
+try:
+    import pikepdf  # optional, merges pdfs in-process by QPDF
+except ImportError:
+    pikepdf = None
+
 
 class RotatedPdfException(Exception):
     """Ratio of pdf-width / pdf_height does not agree with the ratio image_width / image_height."""
@@ -17,28 +31,93 @@ def image_from_pdf_page(pdf_path: str,
                         page_num: int,
                         dpi: int = 150,
                         return_numpy: bool = True,
-                        rotate_by: int = 0) -> Union[Image.Image, np.ndarray]:
+                        rotate_by: int = 0,
+                        backend: str = "poppler") -> Union[Image.Image, np.ndarray]:
     """Return the requested page as a png-image PIL object (no file creation) or a numpy array.
 
-    Page numbers are counted from zero.
+    Page numbers are counted from zero. The numpy array is a read-only view of the decoded image,
+    callers that modify it should make their own copy. The image is rotated counter-clockwise by `rotate_by` degrees.
+
+    :param backend: "poppler" (default) renders the page by pdftoppm,
+        "pymupdf" renders it in-process with `image_from_fitz_page` (requires PyMuPDF)
+    """
+    if backend == "pymupdf":
+        if fitz is None:
+            raise ImportError("PyMuPDF is not installed, cannot render pdf pages with fitz")
+        with fitz.open(pdf_path) as doc:
+            img = image_from_fitz_page(doc, page_num=page_num, dpi=dpi)
+    else:
+        assert backend == "poppler", f"unknown backend: '{backend}'"
+        images = pdf2image.convert_from_path(
+            pdf_path,
+            dpi=dpi,
+            output_folder=None,
+            first_page=page_num + 1,
+            last_page=page_num + 1,
+            fmt='png',
+            thread_count=1,
+            userpw=None,
+            use_cropbox=False,
+            strict=False)
+        img = images[0]
+    quarter_turns, remainder = divmod(rotate_by, 90)
+    if return_numpy and not remainder:
+        # rotation by multiples of 90 degrees as a (non-contiguous) view of the pixels, without a rotated copy
+        return np.rot90(np.asarray(img), k=quarter_turns % 4)
+    if rotate_by:
+        img = img.rotate(rotate_by, expand=True)
+    if return_numpy:
+        img = np.asarray(img)
+    return img
+
+
+def image_from_fitz_page(doc: "fitz.Document", page_num: int, dpi: int = 150) -> Image.Image:
+    """Render a page of an already opened PyMuPDF document as an RGB image.
+
+    No subprocess is spawned and no png is encoded / decoded, the raw pixels are wrapped into a PIL image.
+    Keeping the document open across pages (see `Pdf.page_image`) amortizes parsing of the pdf.
+
+    :param doc: document opened by `fitz.open`
+    :param page_num: page number, starting from zero
+    :param dpi: dpi
+    :return: image of the pdf page
+    """
+    pix = doc[page_num].get_pixmap(dpi=dpi, alpha=False)
+    img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    img.info["dpi"] = (dpi, dpi)  # as in the pngs rendered by pdftoppm, used by ocr
+    return img
+
+
+def images_from_pdf(pdf_path: str,
+                    dpi: int = 150,
+                    first_page: int = 0,
+                    last_page: Optional[int] = None,
+                    thread_count: Optional[int] = None) -> List[Image.Image]:
+    """Render a range of pdf pages into PIL images with one call of pdf2image.
+
+    pdf2image splits the page range among `thread_count` pdftoppm processes running in parallel.
+    Page numbers are counted from zero, `last_page` is inclusive (None means the last page of the pdf).
+
+    :param pdf_path: path to the pdf file
+    :param dpi: resolution of images
+    :param first_page: index of the first rendered page
+    :param last_page: index of the last rendered page
+    :param thread_count: number of pdftoppm processes; by default one less than the number of cpus
+    :return: list of images, one per page
     """
-    images = pdf2image.convert_from_path(
+    if thread_count is None:
+        thread_count = max(1, (os.cpu_count() or 1) - 1)
+    return pdf2image.convert_from_path(
         pdf_path,
         dpi=dpi,
         output_folder=None,
-        first_page=page_num + 1,
-        last_page=page_num + 1,
+        first_page=first_page + 1,
+        last_page=None if last_page is None else last_page + 1,
         fmt='png',
-        thread_count=1,
+        thread_count=thread_count,
         userpw=None,
         use_cropbox=False,
         strict=False)
-    img = images[0]
-    if rotate_by:
-        img = img.rotate(rotate_by, expand=True)
-    if return_numpy:
-        img = np.array(img)
-    return img
 
 
 def pdf_box_to_image_box(pdf_box: Rectangle,
@@ -55,18 +134,75 @@ def pdf_box_to_image_box(pdf_box: Rectangle,
     :param img_height:
     :return: a corresponding Rectangle in the image-coordinates
     """
+    w_scale, h_scale = _pdf_to_image_scales(pdf_width, pdf_height, img_width, img_height)
+    x_min, y_min, x_max, y_max = pdf_box.x_min, pdf_box.y_min, pdf_box.x_max, pdf_box.y_max
+    return Rectangle(x_min * w_scale, y_min * h_scale, x_max * w_scale, y_max * h_scale, dtype=int)
+
+
+def pdf_boxes_to_image_boxes(boxes: np.ndarray,
+                             pdf_width: int,
+                             pdf_height: int,
+                             img_width: int,
+                             img_height: int) -> np.ndarray:
+    """Convert many boxes in pdf coordinates into image coordinates at once.
+
+    :param boxes: array of shape (N, 4), each row being x_min, y_min, x_max, y_max in pdf coordinates
+    :param pdf_width:
+    :param pdf_height:
+    :param img_width:
+    :param img_height:
+    :return: integer array of shape (N, 4) with the corresponding boxes in image coordinates
+    """
+    w_scale, h_scale = _pdf_to_image_scales(pdf_width, pdf_height, img_width, img_height)
+    scales = np.array([w_scale, h_scale, w_scale, h_scale])
+    return (np.asarray(boxes, dtype=float).reshape(-1, 4) * scales).astype(np.int32)
+
+
+def pdf_to_image_affine(pdf_width: float, pdf_height: float, dpi: int = 150, rotate_by: int = 0) -> np.ndarray:
+    """Return the affine map from pdf coordinates (in points) into pixels of the page rendered with given dpi.
+
+    The map is a 3x3 matrix acting on columns (x, y, 1); its inverse maps pixels back into the pdf.
+    The image may be rotated counter-clockwise by `rotate_by` degrees, as in `image_from_pdf_page`.
+
+    :param pdf_width: width of the pdf page, as seen by the end-user (see `Pdf.get_width_height`)
+    :param pdf_height: height of the pdf page
+    :param dpi: resolution of the image
+    :param rotate_by: multiple of 90 degrees
+    :return: array of shape (3, 3)
+    """
+    quarter_turns, remainder = divmod(rotate_by, 90)
+    assert not remainder, f"only rotations by multiples of 90 degrees are supported, got {rotate_by}"
+    scale = dpi / 72
+    affine = np.diag([scale, scale, 1.0])
+    width, height = pdf_width * scale, pdf_height * scale
+    for _ in range(quarter_turns % 4):
+        # a counter-clockwise quarter turn moves the pixel (x, y) of an image of width `width` to (y, width - x)
+        affine = np.array([[0.0, 1.0, 0.0], [-1.0, 0.0, width], [0.0, 0.0, 1.0]]) @ affine
+        width, height = height, width
+    return affine
+
+
+def transform_boxes(boxes: np.ndarray, affine: np.ndarray) -> np.ndarray:
+    """Map many boxes by an affine map at once, e.g. from `pdf_to_image_affine` or its inverse.
+
+    All four corners of every box are mapped by one matrix product, the results are boxes enclosing the mapped corners.
+
+    :param boxes: array of shape (N, 4), each row being x_min, y_min, x_max, y_max
+    :param affine: array of shape (3, 3)
+    :return: float array of shape (N, 4) with the mapped boxes
+    """
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    xs, ys = boxes[:, [0, 2, 0, 2]], boxes[:, [1, 1, 3, 3]]
+    mapped_xs, mapped_ys = np.tensordot(affine[:2], np.stack([xs, ys, np.ones_like(xs)]), axes=1)
+    return np.stack(
+        [mapped_xs.min(axis=1), mapped_ys.min(axis=1), mapped_xs.max(axis=1), mapped_ys.max(axis=1)], axis=1)
+
+
+def _pdf_to_image_scales(pdf_width: int, pdf_height: int, img_width: int, img_height: int) -> Tuple[float, float]:
+    """Horizontal and vertical scales from pdf into image coordinates, rotated pages raise RotatedPdfException."""
     if abs(img_height / img_width - pdf_height / pdf_width) > 0.1:
         raise RotatedPdfException("Pdf seems to be rotated, skipping")
-
-    w_scale = img_width / pdf_width
-    h_scale = img_width / pdf_width
-    return Rectangle(
-        x_min=pdf_box.x_min * w_scale,
-        y_min=pdf_box.y_min * h_scale,
-        x_max=pdf_box.x_max * w_scale,
-        y_max=pdf_box.y_max * h_scale,
-        dtype=int,
-    )
+    return img_width / pdf_width, img_height / pdf_height
 
 
 def save_images_to_pdf(images: List[Image.Image], output_pdf: str) -> None:
@@ -74,9 +210,38 @@ def save_images_to_pdf(images: List[Image.Image], output_pdf: str) -> None:
     images[0].save(output_pdf, "PDF", save_all=True, append_images=images[1:])
 
 
-def merge_pdfs(output_pdf_path, *pdf_paths):
-    """Merge pdfs."""
-    subprocess.run(["pdfunite", *pdf_paths, output_pdf_path])
+def merge_pdfs(output_pdf_path: str, *pdf_paths: Union[str, Path]) -> None:
+    """Merge pdfs given by their paths.
+
+    The pdfs are merged in-process (by pikepdf if installed, otherwise by PyPDF2), so that no pdfunite
+    process is spawned with a command line that may exceed the system limit for large documents.
+    """
+    _merge_pdf_sources(output_pdf_path, [str(path) for path in pdf_paths])
+
+
+def merge_pdf_contents(output_pdf_path: str, *pdf_contents: bytes) -> None:
+    """Merge pdfs given by their content (e.g. created in memory), without writing them to disc and running pdfunite."""
+    _merge_pdf_sources(output_pdf_path, [BytesIO(content) for content in pdf_contents])
+
+
+def _merge_pdf_sources(output_pdf_path: str, sources: List[Union[str, BinaryIO]]) -> None:
+    """Write all pages of the pdfs given by paths or binary streams into one pdf, in the order of the sources."""
+    with ExitStack() as stack:  # the inputs must stay open until the merged pdf is written
+        if pikepdf is not None:
+            merged = stack.enter_context(pikepdf.Pdf.new())
+            for source in sources:
+                merged.pages.extend(stack.enter_context(pikepdf.open(source)).pages)
+            merged.save(output_pdf_path, object_stream_mode=pikepdf.ObjectStreamMode.generate)
+            return
+
+        writer = PdfFileWriter()
+        for source in sources:
+            stream = stack.enter_context(open(source, "rb")) if isinstance(source, str) else source
+            reader = PdfFileReader(stream)
+            for page_idx in range(reader.getNumPages()):
+                writer.addPage(reader.getPage(page_idx))
+        with open(output_pdf_path, "wb") as f:
+            writer.write(f)
 
 
 def get_indices_of_words(words: List[str], char_span: Tuple[int, int]) -> Dict:
@@ -89,18 +254,28 @@ def get_indices_of_words(words: List[str], char_span: Tuple[int, int]) -> Dict:
         'full words': list of indices of words that are fully included in the char_span,
         'partial words': list of indices of words that are partially included in the char_span,
     """
-    lo, hi = char_span
-    ind, full_words, partial_words = 0, [], []
-    for i, w in enumerate(words):
-        current_lo, current_hi = ind, ind + len(w)
-        if lo <= current_lo and hi >= current_hi:
-            full_words.append(i)
-        elif lo < current_hi and hi > current_lo:
-            partial_words.append(i)
-        else:  # no intersection
-            pass
-        ind += len(w) + 1  # update counter
-    return {
-        "full_words": full_words,
-        "partial_words": partial_words
-    }
+    return get_indices_of_words_for_spans(words, [char_span])[0]
+
+
+def get_indices_of_words_for_spans(words: List[str], char_spans: List[Tuple[int, int]]) -> List[Dict]:
+    """Compute matched words for many spans within the same words, e.g. all matches of a pattern in one flow.
+
+    Positions of the words are computed once, and all spans are compared with all words in one broadcast.
+
+    :param words: list of words (strings)
+    :param char_spans: list of spans (lower_index, upper_index) within ' '.join(words), see `get_indices_of_words`
+    :return: list of dictionaries with 'full_words' and 'partial_words', one for each span
+    """
+    lengths = np.fromiter((len(w) for w in words), dtype=np.int64, count=len(words))
+    # start of each word within ' '.join(words): previous starts plus lengths plus one separating space
+    starts = np.zeros_like(lengths)
+    np.cumsum(lengths[:-1] + 1, out=starts[1:])
+    ends = starts + lengths
+    spans = np.array(char_spans, dtype=np.int64).reshape(-1, 2)
+    lo, hi = spans[:, :1], spans[:, 1:]
+    full_mask = (lo <= starts) & (hi >= ends)
+    partial_mask = (lo < ends) & (hi > starts) & ~full_mask
+    return [{
+        "full_words": np.flatnonzero(full).tolist(),
+        "partial_words": np.flatnonzero(partial).tolist()
+    } for full, partial in zip(full_mask, partial_mask)]
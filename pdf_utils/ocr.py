@@ -1,79 +1,361 @@
 """Tesseracting images and converting them to pdf."""
-from typing import Dict, List
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+from tempfile import TemporaryDirectory
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple, Union
 
+import numpy as np
 import pytesseract
 from PIL import Image
 from reportlab.lib.utils import ImageReader
 from reportlab.pdfgen.canvas import Canvas
 
+from pdf_utils.converter import merge_pdf_contents
 from pdf_utils.rectangle import Rectangle
 
+try:
+    import tesserocr  # optional in-process binding of libtesseract, avoids one tesseract process per image
+except ImportError:
+    tesserocr = None
+
+# tesseract options that can be passed to tesserocr api directly
+_TESSEROCR_OPTIONS = re.compile(r"--(psm|oem)\s+(\d+)")
+
 
 class Scanner:
     """Ocr image, create searchable pdf from images."""
 
+    # tesseract has been observed to hang on very long image lists
+    max_images_per_tesseract_call = 50
+    # tesserocr apis, per thread; creating one loads the language model, so they are reused across images
+    _tesserocr_apis = threading.local()
+
     @classmethod
     def ocr_one_image(cls,
-                      img: Image.Image,
+                      img: Union[Image.Image, np.ndarray],
                       lang: str = "eng",
                       config: str = "--psm 1 --oem 3") -> List[Dict]:
         """Compute a dictionary with detected words and bounding boxes.
 
-        :param img: input image
+        If tesserocr is installed, the image is ocr-ed in-process by libtesseract, otherwise by pytesseract.
+
+        :param img: input image, PIL image or numpy array of 8-bit pixels (such as `image_from_pdf_page` returns)
         :param lang: language code
         :param config: tesseract configuration
         :return: list of dictionaries of type {"word": word, "bb": bounding box of the word, relative to page size}
         """
-        d = pytesseract.image_to_data(
-            img, output_type=pytesseract.Output.DICT, lang=lang, config=config)
+        api = cls._tesserocr_api(lang, config)
+        if api is not None:
+            d = cls._tesserocr_data(api, img)
+        else:
+            d = pytesseract.image_to_data(
+                img, output_type=pytesseract.Output.DICT, lang=lang, config=config)
+        width, height = (img.shape[1], img.shape[0]) if isinstance(img, np.ndarray) else img.size
+        return cls._words_with_boxes(d, range(len(d["text"])), width=width, height=height)
+
+    @staticmethod
+    def uses_tesserocr(config: str) -> bool:
+        """Tell whether images are ocr-ed in-process by tesserocr for this tesseract configuration."""
+        return tesserocr is not None and not _TESSEROCR_OPTIONS.sub("", config).strip()
+
+    @classmethod
+    def _tesserocr_api(cls, lang: str, config: str) -> Optional["tesserocr.PyTessBaseAPI"]:
+        """Return in-process tesseract api for given language and configuration, or None if it cannot be used.
+
+        Only the options "--psm N" and "--oem N" are understood; other configurations are left to pytesseract.
+        """
+        if not cls.uses_tesserocr(config):
+            return None
+        options = {name: int(value) for name, value in _TESSEROCR_OPTIONS.findall(config)}
+        apis = getattr(cls._tesserocr_apis, "apis", None)
+        if apis is None:
+            apis = cls._tesserocr_apis.apis = {}
+        key = (lang, options.get("psm"), options.get("oem"))
+        if key not in apis:
+            apis[key] = tesserocr.PyTessBaseAPI(lang=lang, **options)
+        return apis[key]
+
+    @staticmethod
+    def _tesserocr_data(api: "tesserocr.PyTessBaseAPI", img: Union[Image.Image, np.ndarray]) -> Dict[str, List]:
+        """Ocr image with tesserocr api and return words and boxes in the format of pytesseract.image_to_data.
+
+        Raw pixels are handed over to tesseract, instead of letting tesserocr encode the image and decode it again.
+        Raw pixels carry no resolution, so the dpi of a PIL image (e.g. rendered by pdftoppm) is passed along,
+        as it would be in the png written by pytesseract; otherwise tesseract estimates it.
+        """
+        d = {"text": [], "left": [], "top": [], "width": [], "height": []}
+        if isinstance(img, Image.Image):
+            dpi = img.info.get("dpi")
+            if img.mode not in ("L", "RGB", "RGBA"):
+                img = img.convert("RGB")
+            width, height = img.size
+            channels = len(img.getbands())
+            pixels = img.tobytes()  # 8-bit pixels row by row, as tesseract expects them
+        else:
+            dpi = None
+            array = np.ascontiguousarray(img, dtype=np.uint8)  # copies only non-contiguous views, e.g. rotated pages
+            height, width = array.shape[:2]
+            channels = 1 if array.ndim == 2 else array.shape[2]
+            pixels = array.tobytes()
+        api.SetImageBytes(pixels, width, height, channels, width * channels)
+        if dpi:
+            api.SetSourceResolution(int(round(dpi[0])))
+        api.Recognize()
+        iterator = api.GetIterator()
+        if iterator is None:  # nothing recognized
+            return d
+        level = tesserocr.RIL.WORD
+        for word in tesserocr.iterate_level(iterator, level):
+            text, box = word.GetUTF8Text(level), word.BoundingBox(level)
+            if text is None or box is None:
+                continue
+            x_min, y_min, x_max, y_max = box
+            d["text"].append(text)
+            d["left"].append(x_min)
+            d["top"].append(y_min)
+            d["width"].append(x_max - x_min)
+            d["height"].append(y_max - y_min)
+        return d
+
+    @classmethod
+    def ocr_many_images(cls,
+                        images: List[Image.Image],
+                        lang: str = "eng",
+                        config: str = "--psm 1 --oem 3") -> List[List[Dict]]:
+        """Ocr many images with a single tesseract run per (at most `max_images_per_tesseract_call`) images.
+
+        Starting tesseract and loading its language model is a considerable part of ocr-ing one image,
+        here it is paid once per batch. Images are passed to tesseract as a list file.
+
+        :param images: input images
+        :param lang: language code
+        :param config: tesseract configuration
+        :return: for each image, the same output as `ocr_one_image` would give
+        """
         result = []
-        for i, word in enumerate(d["text"]):
-            if word.strip():
-                left, top, width, height = d["left"][i], d["top"][i], d["width"][i], d["height"][i]
-                result.append({
-                    "word": word,
-                    "bb": Rectangle(
-                        x_min=left,
-                        y_min=top,
-                        x_max=left + width,
-                        y_max=top + height).relative_to_size(width=img.size[0], height=img.size[1])})
+        for start in range(0, len(images), cls.max_images_per_tesseract_call):
+            batch = images[start:start + cls.max_images_per_tesseract_call]
+            with TemporaryDirectory() as temp_dir:
+                image_paths = []
+                for i, img in enumerate(batch):
+                    image_paths.append(os.path.join(temp_dir, f"{i}.png"))
+                    img.save(image_paths[-1])
+                list_path = os.path.join(temp_dir, "images.txt")
+                with open(list_path, "w") as f:
+                    f.write("\n".join(image_paths) + "\n")
+                d = pytesseract.image_to_data(
+                    list_path, output_type=pytesseract.Output.DICT, lang=lang, config=config)
+
+            # rows of the tsv output are tagged by `page_num`, counting input images from 1
+            rows_of_image = [[] for _ in batch]
+            for i, page_num in enumerate(d["page_num"]):
+                rows_of_image[page_num - 1].append(i)
+            result.extend(
+                cls._words_with_boxes(d, rows, width=img.size[0], height=img.size[1])
+                for img, rows in zip(batch, rows_of_image))
         return result
 
+    @classmethod
+    def ocr_images_parallel(cls,
+                            images: Iterable[Image.Image],
+                            lang: str = "eng",
+                            config: str = "--psm 1 --oem 3",
+                            max_workers: Optional[int] = None) -> List[List[Dict]]:
+        """Ocr images concurrently, each thread ocr-ing one image by `ocr_one_image`.
+
+        With tesserocr, each thread recognizes its image in-process by its own libtesseract api, which releases
+        the GIL while recognizing; otherwise each thread runs one tesseract process. Either way the work happens
+        outside of python, so threads are enough to keep all cores busy.
+        Tesseract may use several threads itself (OpenMP); setting the environment variable
+        `OMP_THREAD_LIMIT=1` avoids over-subscription of cores. Images should be of the resolution intended for ocr.
+
+        :param images: input images
+        :param lang: language code
+        :param config: tesseract configuration
+        :param max_workers: number of images ocr-ed concurrently, by default min(cpu_count, 8)
+        :return: for each image, the output of `ocr_one_image`, in the order of images
+        """
+        max_workers = max_workers or min(os.cpu_count() or 1, 8)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda img: cls.ocr_one_image(img, lang, config), images))
+
+    @staticmethod
+    def _words_with_boxes(d: Dict[str, List], rows: Iterable[int], width: int, height: int) -> List[Dict]:
+        """Collect nonempty words and their bounding boxes from (selected rows of) tesseract's output.
+
+        :param d: output of pytesseract.image_to_data, as a dictionary
+        :param rows: indices of rows to consider
+        :param width: width of the ocr-ed image
+        :param height: height of the ocr-ed image
+        :return: list of dictionaries of type {"word": word, "bb": bounding box of the word, relative to page size}
+        """
+        text = d["text"]
+        rows = np.fromiter((i for i in rows if text[i].strip()), dtype=np.intp)
+        # normalize to page size right away, instead of creating a pixel-Rectangle and rescaling it
+        inv_width, inv_height = 1.0 / width, 1.0 / height
+        left = np.asarray(d["left"], dtype=np.int32)[rows]
+        top = np.asarray(d["top"], dtype=np.int32)[rows]
+        right = (left + np.asarray(d["width"], dtype=np.int32)[rows]) * inv_width
+        bottom = (top + np.asarray(d["height"], dtype=np.int32)[rows]) * inv_height
+        left = left * inv_width
+        top = top * inv_height
+        return [
+            {"word": text[i], "bb": Rectangle(x_min=x_min, y_min=y_min, x_max=x_max, y_max=y_max)}
+            for i, x_min, y_min, x_max, y_max in zip(
+                rows.tolist(), left.tolist(), top.tolist(), right.tolist(), bottom.tolist())]
+
     @classmethod
     def image_to_one_page_ocred_pdf(cls,
                                     im: Image.Image,
-                                    pdf_path: str,
+                                    pdf_path: Union[str, BinaryIO],
                                     pdf_width: int,
                                     pdf_height: int,
                                     ocr_text: List[Dict],
-                                    font_name: str = "Helvetica") -> None:
+                                    font_name: str = "Helvetica",
+                                    jpeg_quality: Optional[int] = None,
+                                    embed_jpeg_file: bool = False) -> None:
         """Convert the image into a pdf with added textual layer and store it to disc.
 
         Run tesseract OCR and add invisible textual content so that the pdf is searchable / clickable.
 
         :param im: input image
-        :param pdf_path: path to output pdf
+        :param pdf_path: path to output pdf, or a binary file-like object the pdf is written into
         :param pdf_width: widht of the pdf to be created (points)
         :param pdf_height: height of the pdf to be created (points)
         :param ocr_text: information about words and their bounding boxes in relative coordinates
         (such as the output of `ocr_one_image`)
         :param font_name
+        :param jpeg_quality: if given, the image is embedded as jpeg of this quality, which reportlab passes
+            through as it is; by default the raw pixels are compressed losslessly by reportlab
+        :param embed_jpeg_file: if True, an image opened from a jpeg file is embedded straight from that file,
+            without decoding and re-encoding (`jpeg_quality` does not apply then). The file is used only if its
+            image has the size and mode of `im`; other modifications in place (e.g. drawing) cannot be detected,
+            so set this only for images not modified since opening.
         """
         new_pdf = Canvas(pdf_path, pagesize=(pdf_width, pdf_height))
+        image = im
+        if embed_jpeg_file and cls._is_stored_as_jpeg(im):
+            image = im.filename
+        elif jpeg_quality is not None:
+            image = BytesIO()
+            im.convert("RGB").save(image, "JPEG", quality=jpeg_quality)
+            image.seek(0)
         new_pdf.drawImage(
-            ImageReader(im),
+            ImageReader(image),
             0, 0, width=pdf_width, height=pdf_height)
 
+        # all words go through one text object, instead of one text object (and drawText call) per word
+        text = new_pdf.beginText()
+        text.setTextRenderMode(3)  # invisible
+        # string width is linear in the font size, so widths at unit size are measured once per distinct word
+        unit_widths = {}
+        # words on one line tend to have the same height, the font is switched only when the size changes
+        font_size = None
         for word_and_position in ocr_text:
             word = word_and_position["word"]
             bb = word_and_position["bb"].rescale(multiply_width_by=pdf_width, multiply_height_by=pdf_height)
 
-            text = new_pdf.beginText()
-            text.setFont(font_name, bb.height)
-            text.setTextRenderMode(3)  # invisible
+            if bb.height != font_size:
+                font_size = bb.height
+                text.setFont(font_name, font_size)
             text.setTextOrigin(bb.x_min, pdf_height - bb.y_max)  # bottom-left corner
-            text.setHorizScale(100 * bb.width / new_pdf.stringWidth(word, font_name, bb.height))
+            if word not in unit_widths:
+                unit_widths[word] = new_pdf.stringWidth(word, font_name, 1)
+            text.setHorizScale(100 * bb.width / (unit_widths[word] * bb.height))
             text.textLine(word)
-            new_pdf.drawText(text)
+        new_pdf.drawText(text)
 
         new_pdf.save()
+
+    @staticmethod
+    def _is_stored_as_jpeg(im: Image.Image) -> bool:
+        """Tell whether the image was opened from a jpeg file, which still holds an image of the same size and mode.
+
+        Only the header of the file is read.
+        """
+        if im.format != "JPEG" or not getattr(im, "filename", ""):
+            return False
+        with Image.open(im.filename) as stored:
+            return stored.format == "JPEG" and stored.size == im.size and stored.mode == im.mode
+
+    @classmethod
+    def images_to_ocred_pdf(cls,
+                            images: List[Image.Image],
+                            output_pdf: str,
+                            pdf_sizes: List[Tuple[int, int]],
+                            images_for_ocr: Optional[List[Image.Image]] = None,
+                            lang: str = "eng",
+                            config: str = "--psm 1 --oem 3",
+                            max_workers: Optional[int] = None,
+                            jpeg_quality: Optional[int] = None) -> None:
+        """Ocr images and merge them into one searchable pdf, each image on one page.
+
+        Pages are processed concurrently, each job ocr-s one image and creates one page of the pdf.
+        With tesserocr, which releases the GIL while recognizing, the jobs run in threads sharing the images.
+        Otherwise they run in a process pool and images are handed over to the workers as png files, not pickled.
+
+        :param images: images to be inserted into the pdf pages
+        :param output_pdf: path to the output pdf
+        :param pdf_sizes: (width, height) of each pdf page to be created (points)
+        :param images_for_ocr: if given, these images (e.g. of higher resolution) are ocr-ed instead of `images`
+        :param lang: language code
+        :param config: tesseract configuration
+        :param max_workers: number of threads (by default cpu_count) with tesserocr, or of worker processes
+            (by default cpu_count // 4, as tesseract itself typically runs up to 4 threads per image)
+        :param jpeg_quality: if given, images are embedded as jpeg, see `image_to_one_page_ocred_pdf`
+        """
+        images_for_ocr = images if images_for_ocr is None else images_for_ocr
+        pdf_widths, pdf_heights = zip(*pdf_sizes)
+        if cls.uses_tesserocr(config):
+            with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as executor:
+                pdf_pages = list(executor.map(
+                    lambda img, img_for_ocr, pdf_width, pdf_height: cls._ocr_image_to_pdf(
+                        img, img_for_ocr, pdf_width, pdf_height, lang, config, jpeg_quality),
+                    images, images_for_ocr, pdf_widths, pdf_heights))
+        else:
+            with TemporaryDirectory() as temp_dir:
+                image_paths, ocr_image_paths = [], []
+                for page_idx, (img, img_for_ocr) in enumerate(zip(images, images_for_ocr)):
+                    image_paths.append(os.path.join(temp_dir, f"{page_idx}.png"))
+                    img.save(image_paths[-1])
+                    ocr_image_paths.append(image_paths[-1])
+                    if img_for_ocr is not img:
+                        ocr_image_paths[-1] = os.path.join(temp_dir, f"{page_idx}_ocr.png")
+                        img_for_ocr.save(ocr_image_paths[-1])
+                n_pages = len(image_paths)
+                with ProcessPoolExecutor(max_workers=max_workers or max(1, (os.cpu_count() or 1) // 4)) as executor:
+                    pdf_pages = list(executor.map(
+                        _ocr_page_to_pdf, image_paths, ocr_image_paths, pdf_widths, pdf_heights,
+                        [lang] * n_pages, [config] * n_pages, [jpeg_quality] * n_pages))
+        merge_pdf_contents(output_pdf, *pdf_pages)
+
+    @classmethod
+    def _ocr_image_to_pdf(cls,
+                          img: Image.Image,
+                          img_for_ocr: Image.Image,
+                          pdf_width: int,
+                          pdf_height: int,
+                          lang: str,
+                          config: str,
+                          jpeg_quality: Optional[int] = None) -> bytes:
+        """Ocr one image and create a one-page searchable pdf out of it, in memory."""
+        ocr_text = cls.ocr_one_image(img_for_ocr, lang, config)
+        pdf_page = BytesIO()
+        cls.image_to_one_page_ocred_pdf(
+            img, pdf_page, pdf_width=pdf_width, pdf_height=pdf_height, ocr_text=ocr_text, jpeg_quality=jpeg_quality)
+        return pdf_page.getvalue()
+
+
+def _ocr_page_to_pdf(image_path: str,
+                     ocr_image_path: str,
+                     pdf_width: int,
+                     pdf_height: int,
+                     lang: str,
+                     config: str,
+                     jpeg_quality: Optional[int] = None) -> bytes:
+    """Ocr one stored page image and create a one-page searchable pdf (a module-level function, for process pools)."""
+    with Image.open(image_path) as img, Image.open(ocr_image_path) as img_for_ocr:
+        return Scanner._ocr_image_to_pdf(img, img_for_ocr, pdf_width, pdf_height, lang, config, jpeg_quality)
@@ -3,25 +3,36 @@
 Main methods support extracting textual content, extracting images, localizing positions of words,
 extracting annotations, and converting an image-like pdf into "searchable" pdf via doing ocr.
 """
+import hashlib
 import logging
-import shutil
+import os
 import subprocess
 from pathlib import Path
 from sys import platform
-from tempfile import mkdtemp
-from typing import Dict, Iterable, List, Optional, Tuple, Union
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 from PIL import Image
 from PyPDF2 import PdfFileReader
-from lxml import html
+from PyPDF2.pdf import PageObject
+from lxml import etree, html
 
-from pdf_utils.converter import image_from_pdf_page, merge_pdfs
+from pdf_utils.converter import (
+    image_from_fitz_page, image_from_pdf_page, images_from_pdf, pdf_boxes_to_image_boxes, pdf_to_image_affine)
 from pdf_utils.ocr import Scanner
 from pdf_utils.rectangle import Rectangle
 
+try:
+    import fitz  # PyMuPDF, optional in-process renderer of pdf pages
+except ImportError:
+    fitz = None
+
 logger = logging.getLogger(__name__)
 
+# compiled once, instead of parsing the path expression on every call
+WORDS_XPATH = etree.XPath(".//word")
+PAGES_XPATH = etree.XPath(".//page")
+
 
 class CannotReadPdf(Exception):
     """PyPDF2 cannot read the pdf."""
@@ -30,37 +41,83 @@ class CannotReadPdf(Exception):
 class Pdf:
     """Process one pdf file."""
 
-    parser = html.HTMLParser(encoding="utf-8")
+    # huge_tree lifts libxml2 limits on depth and text size of large outputs, ids of elements are not needed
+    parser = html.HTMLParser(encoding="utf-8", huge_tree=True, no_network=True, collect_ids=False)
+    # if set to a folder, outputs of pdftotext are cached there across runs, keyed by hash of the pdf content
+    text_cache_dir: Optional[Union[str, Path]] = None
 
     def __init__(self, pdf_path: Union[str, Path]) -> None:
         """Define pdf path, pdf reader, initialize images."""
         self.pdf_path = Path(pdf_path)
-        self.pdf_file = open(self.pdf_path, 'rb')
-        self.pdf_reader = PdfFileReader(self.pdf_file)
-
-        if self.pdf_reader.isEncrypted:
-            try:
-                self.pdf_reader.decrypt("")
-            except NotImplementedError:
-                raise CannotReadPdf(f"cannot decrypt pdf file: {pdf_path}")
+        # the file is opened by `pdf_reader` only when needed, and closed again after use
+        self.pdf_file = None
+        self._pdf_reader = None
+        # number of pages, sizes and rotations of pages are read at once, so that the file does not stay open
+        try:
+            self._read_pages_geometry()  # also checks that the pdf can be read
+        finally:
+            self._close_reader()
 
         self._images = {}
-        self._rotated = {}
-
-        self._simple_text = None  # results of simple pdftotext
-        self._layout_text = None  # result of pdftotext with -layout param
+        self._images_dpi_cache = {}  # images of all pages rendered at once, as {dpi: list of images}, see `all_images`
+        self._affines = {}  # {(page_idx, dpi, rotate_by): pdf -> image affine map}, see `pdf_to_image_affine`
+
+        # outputs of pdftotext, as {(layout argument, page_idx): bytes}; each flavour is extracted at most once
+        self._pdftotext_outputs = {}
+        self._pdftotext_texts = {}  # the same outputs decoded into str, for the flavours asked for as text
+        # word elements of parsed pages, as {page_idx: list of words (as xml elements)}
+        self._word_elements = {}
+        self._word_texts = {}  # the same words as strings
         # root of the xml tree representing the `pdftotext -bbox-layout output that includes bounding boxes of words
         self._root = None
+        self._bbox_pages = None  # page elements of self._root
+        self._content_hash = None
+        # PyMuPDF document, opened on first in-process rendering of a page and kept open for the other pages
+        self._fitz_document = None
 
     @property
     def name(self) -> str:
         """Return pdf's file name."""
         return self.pdf_path.name
 
+    @property
+    def content_hash(self) -> str:
+        """Return sha256 hex digest of the pdf file content."""
+        if self._content_hash is None:
+            self._content_hash = hashlib.sha256(self.pdf_path.read_bytes()).hexdigest()
+        return self._content_hash
+
+    @property
+    def pdf_reader(self) -> PdfFileReader:
+        """Return PyPDF2 reader of the pdf; the file is opened on first use and kept open until it is closed.
+
+        Methods of this package that need the reader close it when they are done.
+        """
+        if self._pdf_reader is None:
+            self.pdf_file = open(self.pdf_path, 'rb')
+            reader = PdfFileReader(self.pdf_file)
+            if reader.isEncrypted:
+                try:
+                    reader.decrypt("")
+                except NotImplementedError:
+                    self.close()
+                    raise CannotReadPdf(f"cannot decrypt pdf file: {self.pdf_path}")
+            self._pdf_reader = reader
+        return self._pdf_reader
+
+    @property
+    def fitz_document(self) -> "fitz.Document":
+        """Return the pdf opened by PyMuPDF; it is opened once and reused for all pages."""
+        if self._fitz_document is None:
+            if fitz is None:
+                raise ImportError("PyMuPDF is not installed, cannot render pdf pages with fitz")
+            self._fitz_document = fitz.open(str(self.pdf_path))
+        return self._fitz_document
+
     @property
     def number_of_pages(self) -> int:
         """Get number of pages in the pdf."""
-        return self.pdf_reader.getNumPages()
+        return self._number_of_pages
 
     def get_width_height(self, page_idx: int = 0) -> Tuple[int, int]:
         """Return the with and height of the pdf page.
@@ -68,13 +125,38 @@ class Pdf:
         If pdf page is internally rotated by 90 or 270 degrees, we swap the internal pdf width and height.
         This should reflect the width and height that is visible to the end-user.
         """
-        crop_box = self.pdf_reader.getPage(page_idx).cropBox
+        size = self._sizes[page_idx]
+        if isinstance(size, Exception):
+            raise size
+        return size
+
+    def _read_pages_geometry(self) -> None:
+        """Read number of pages, and size and rotation of each page, by PyPDF2.
+
+        A page whose size cannot be read does not fail here, the error is raised when its size is asked for.
+        """
+        reader = self.pdf_reader
+        self._number_of_pages = reader.getNumPages()
+        self._rotated = []
+        self._sizes = []
+        for page_idx in range(self._number_of_pages):
+            page = reader.getPage(page_idx)
+            page_rotation = page.get("/Rotate", 0)
+            self._rotated.append(page_rotation)
+            try:
+                self._sizes.append(self._page_size(page_idx, page, page_rotation))
+            except CannotReadPdf as err:
+                self._sizes.append(err)
+
+    @staticmethod
+    def _page_size(page_idx: int, page: PageObject, page_rotation: int) -> Tuple[int, int]:
+        """Return the size of the page as visible to the end-user, see `get_width_height`."""
+        crop_box = page.cropBox
         if not int(crop_box[0]) == int(crop_box[1]) == 0:
             raise CannotReadPdf(f"cannot read pdf width / height on page {page_idx}, crop_box = {crop_box}")
         pdf_width = int(crop_box.getWidth())
         pdf_height = int(crop_box.getHeight())
 
-        page_rotation = self.page_rotation(page_idx)
         if page_rotation in {90, 270}:
             pdf_width, pdf_height = pdf_height, pdf_width
 
@@ -83,57 +165,191 @@ class Pdf:
 
         return abs(pdf_width), abs(pdf_height)
 
-    def page_rotation(self, page_idx: int) -> bool:
-        """Expose self._rotated."""
-        if page_idx in self._rotated:
-            return self._rotated[page_idx]
-        self._rotated[page_idx] = self.pdf_reader.getPage(page_idx).get("/Rotate", 0)
+    def pdf_to_image_affine(self, page_idx: int, dpi: int = 150, rotate_by: int = 0) -> np.ndarray:
+        """Return (and cache) the 3x3 affine map from pdf coordinates into pixels of the page image.
+
+        Boxes are mapped by `converter.transform_boxes(boxes, affine)`; the inverse matrix maps them back into the pdf.
+        See `converter.pdf_to_image_affine`, the page size is taken from `get_width_height`.
+        """
+        key = (page_idx, dpi, rotate_by)
+        if key not in self._affines:
+            self._affines[key] = pdf_to_image_affine(*self.get_width_height(page_idx), dpi=dpi, rotate_by=rotate_by)
+        return self._affines[key]
+
+    def page_rotation(self, page_idx: int) -> int:
+        """Expose self._rotated, the internal rotation of a page in degrees."""
         return self._rotated[page_idx]
 
     def page_image(self,
                    page_idx: int = 0,
                    dpi: int = 150,
                    recompute: bool = False,
-                   rotation_thres: float = 0.1) -> Union[Image.Image, np.ndarray]:
+                   rotation_thres: float = 0.1,
+                   backend: str = "poppler") -> Union[Image.Image, np.ndarray]:
         """Get the image of a pdf page.
 
         If the page has internal nonzero "Rotation", we ignore it; we just call pdftoppm and don't rotate anything.
         Note that a second call, even with different dpi, will return the cached image, unless 'recompute' flag is on.
+        If all pages have been rendered by `all_images` with the same dpi, that image is reused.
 
         :param page_idx: page number, starting from zero
         :param dpi: dpi
         :param recompute: if True, image will be rerendered even if computed before
         :param rotation_thres: if image w/h ratio and pdf-page w/h ratio differ too much, raise Exception
+        :param backend: "poppler" (default) calls pdftoppm, "pymupdf" renders in-process (requires PyMuPDF)
         :return: image of the pdf page
         """
         # if image already exists, reuse it
         if page_idx in self._images and not recompute:
             img = self._images[page_idx]
+        elif dpi in self._images_dpi_cache and not recompute:
+            img = self._images[page_idx] = self._images_dpi_cache[dpi][page_idx]
         else:
-            img = image_from_pdf_page(str(self.pdf_path), page_num=page_idx, dpi=dpi, return_numpy=False)
-            self._images[page_idx] = img
-
-            w, h = self.get_width_height(page_idx)
-            img_w, img_h = img.size
-            is_inconsistent = abs(img_h / img_w - h / w) > rotation_thres
-            if is_inconsistent:
-                raise CannotReadPdf(f"inconsistent width/height ratio on page {page_idx}: "
-                                    f"page = ({img_w, img_h}), pdf = {(w, h)}")
+            if backend == "pymupdf":
+                img = image_from_fitz_page(self.fitz_document, page_num=page_idx, dpi=dpi)
+            else:
+                img = image_from_pdf_page(
+                    str(self.pdf_path), page_num=page_idx, dpi=dpi, return_numpy=False, backend=backend)
+            self._store_page_image(page_idx, img, rotation_thres)
         return img
 
+    def _store_page_image(self, page_idx: int, img: Image.Image, rotation_thres: float = 0.1) -> None:
+        """Cache the image of a page, after checking that its w/h ratio agrees with the pdf page."""
+        self._images[page_idx] = img
+        self._check_page_image(page_idx, img, rotation_thres)
+
+    def _check_page_image(self, page_idx: int, img: Image.Image, rotation_thres: float = 0.1) -> None:
+        """Raise CannotReadPdf if w/h ratio of the image of a page does not agree with the pdf page."""
+        w, h = self.get_width_height(page_idx)
+        img_w, img_h = img.size
+        is_inconsistent = abs(img_h / img_w - h / w) > rotation_thres
+        if is_inconsistent:
+            raise CannotReadPdf(f"inconsistent width/height ratio on page {page_idx}: "
+                                f"page = ({img_w, img_h}), pdf = {(w, h)}")
+
+    def _render_all_pages(self, dpi: int = 150, thread_count: Optional[int] = None) -> None:
+        """Render all pages not cached yet, with one pdf2image call instead of one pdftoppm process per page."""
+        missing = [page_idx for page_idx in range(self.number_of_pages) if page_idx not in self._images]
+        if not missing:
+            return
+        if dpi in self._images_dpi_cache:
+            first_page, images = 0, self._images_dpi_cache[dpi]
+        else:
+            first_page, last_page = missing[0], missing[-1]
+            images = images_from_pdf(
+                str(self.pdf_path), dpi=dpi, first_page=first_page, last_page=last_page, thread_count=thread_count)
+        for page_idx, img in enumerate(images, start=first_page):
+            if page_idx not in self._images:
+                self._store_page_image(page_idx, img)
+
+    def all_images(self, dpi: int = 150, thread_count: Optional[int] = None) -> List[Image.Image]:
+        """Return images of all pages at the given dpi, rendered by one pdf2image call and cached per dpi.
+
+        :param dpi: dpi
+        :param thread_count: number of pdftoppm processes rendering the pages, see `images_from_pdf`
+        :return: list of images, one per page
+        """
+        if dpi not in self._images_dpi_cache:
+            images = images_from_pdf(str(self.pdf_path), dpi=dpi, thread_count=thread_count)
+            for page_idx, img in enumerate(images):
+                self._check_page_image(page_idx, img)
+            self._images_dpi_cache[dpi] = images
+        return self._images_dpi_cache[dpi]
+
     @property
-    def images(self) -> Iterable[Image.Image]:
-        """Return all images as a list."""
-        return (self.page_image(page_idx) for page_idx in range(self.number_of_pages))
+    def images(self) -> List[Image.Image]:
+        """Return all images as a list.
+
+        All images are rendered and cached on the object; for large pdfs, `iter_images` keeps memory bounded.
+        """
+        self._render_all_pages()
+        return [self._images[page_idx] for page_idx in range(self.number_of_pages)]
+
+    def iter_images(self,
+                    dpi: int = 150,
+                    batch_size: int = 8,
+                    thread_count: Optional[int] = None) -> Iterator[Image.Image]:
+        """Yield images of all pages, rendering the pages in batches.
+
+        Unlike `images`, newly rendered pages are not cached on the object, so at most one batch of images
+        is held in memory at a time. Pages already cached (e.g. by `page_image`) are reused.
+
+        :param dpi: dpi
+        :param batch_size: number of pages rendered by one pdf2image call
+        :param thread_count: number of pdftoppm processes rendering one batch, see `images_from_pdf`
+        :return: images of pages, in the order of pages
+        """
+        for first_page in range(0, self.number_of_pages, batch_size):
+            last_page = min(first_page + batch_size, self.number_of_pages) - 1
+            if all(page_idx in self._images for page_idx in range(first_page, last_page + 1)):
+                batch = [self._images[page_idx] for page_idx in range(first_page, last_page + 1)]
+            else:
+                batch = images_from_pdf(
+                    str(self.pdf_path), dpi=dpi, first_page=first_page, last_page=last_page, thread_count=thread_count)
+            for page_idx, img in enumerate(batch, start=first_page):
+                if page_idx in self._images:
+                    yield self._images[page_idx]
+                else:
+                    self._check_page_image(page_idx, img)
+                    yield img
 
     def extract_text_from_pdf(self,
                               pdftotext_layout_argument: Optional[str] = None,
                               page_idx: Optional[int] = None) -> str:
         """Get textual pdf content. Wrapper of Poppler's pdftotext.
 
+        Results are memoized on the object, so each combination of arguments runs pdftotext at most once.
+        If `text_cache_dir` is set, the result is read from there when the same pdf content has been processed
+        with the same arguments before (in this or in an earlier run), and stored there otherwise.
+
         :param pdftotext_layout_argument: None, "-layout" or "-bbox-layout". Argument passed to the pdftotext
         :return: pdftotext result
         """
+        key = (pdftotext_layout_argument, page_idx)
+        if key not in self._pdftotext_texts:
+            output = self.extract_bytes_from_pdf(pdftotext_layout_argument, page_idx)
+            if output is None:
+                return output
+            self._pdftotext_texts[key] = output.decode("utf-8")
+        return self._pdftotext_texts[key]
+
+    def extract_bytes_from_pdf(self,
+                               pdftotext_layout_argument: Optional[str] = None,
+                               page_idx: Optional[int] = None) -> bytes:
+        """Get pdftotext output as utf-8 encoded bytes, as it is written by pdftotext.
+
+        Same as `extract_text_from_pdf` (sharing its memoization and cache), but without decoding the output.
+        The xml output of "-bbox-layout" is parsed from these bytes directly.
+        """
+        key = (pdftotext_layout_argument, page_idx)
+        if key not in self._pdftotext_outputs:
+            output = self._read_cached_or_run_pdftotext(pdftotext_layout_argument, page_idx)
+            if output is None:
+                return output
+            self._pdftotext_outputs[key] = output
+        return self._pdftotext_outputs[key]
+
+    def _read_cached_or_run_pdftotext(self, pdftotext_layout_argument: Optional[str], page_idx: Optional[int]) -> bytes:
+        """Return pdftotext output from the disc cache in `text_cache_dir` if possible, otherwise run pdftotext."""
+        if self.text_cache_dir is None:
+            return self._run_pdftotext(pdftotext_layout_argument, page_idx)
+
+        page = "all" if page_idx is None else page_idx
+        cache_path = Path(self.text_cache_dir) / f"{self.content_hash}{pdftotext_layout_argument or ''}-{page}.txt"
+        if cache_path.is_file():
+            return cache_path.read_bytes()
+
+        output = self._run_pdftotext(pdftotext_layout_argument, page_idx)
+        if output is not None:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            # write and rename, so that concurrent processes never read a half-written file
+            tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+            tmp_path.write_bytes(output)
+            os.replace(str(tmp_path), str(cache_path))
+        return output
+
+    def _run_pdftotext(self, pdftotext_layout_argument: Optional[str], page_idx: Optional[int]) -> bytes:
+        """Call pdftotext and return its output (utf-8 encoded, with unix line endings)."""
         pdftotext_args = ["pdftotext"]
         if pdftotext_layout_argument is not None:
             pdftotext_args.append(pdftotext_layout_argument)
@@ -142,52 +358,83 @@ class Pdf:
             pdftotext_args.extend(["-f", str(page_idx + 1), "-l", str(page_idx + 1)])
 
         if platform == "linux" or platform == "darwin":
-            return subprocess.check_output(
-                pdftotext_args + [str(self.pdf_path), "-"], universal_newlines=True)
+            return subprocess.check_output(pdftotext_args + [str(self.pdf_path), "-"])
         elif platform == "win32":
             return subprocess.check_output(
-                pdftotext_args + [str(self.pdf_path), "-"], universal_newlines=True, shell=True, encoding='UTF-8')
+                pdftotext_args + [str(self.pdf_path), "-"], shell=True).replace(b"\r\n", b"\n")
         else:
             logging.error("System not recognized")
 
     @property
     def simple_text(self) -> str:
         """Use `pdftotext` to extract textual content."""
-        if self._simple_text is None:
-            self._simple_text = self.extract_text_from_pdf()
-        return self._simple_text
+        return self.extract_text_from_pdf()
 
     @property
     def layout_text(self) -> str:
         """Use `pdftotext -layout` to extract textual content."""
-        if self._layout_text is None:
-            self._layout_text = self.extract_text_from_pdf("-layout")
-        return self._layout_text
+        return self.extract_text_from_pdf("-layout")
 
     def get_page_as_html(self, page_idx: int) -> html.HtmlElement:
-        """Get textual content including bounding boxes of each word, represented as the root of the xml tree."""
-        bbox_text = self.extract_text_from_pdf(pdftotext_layout_argument="-bbox-layout", page_idx=page_idx)
-        return html.fromstring(bbox_text, parser=self.parser)
+        """Get textual content including bounding boxes of each word, represented as the page element of xml tree.
+
+        pdftotext is run (and its output parsed) once for the whole document, pages are elements of the same tree.
+        """
+        return self._get_bbox_pages()[page_idx]
+
+    def _get_bbox_pages(self) -> List[html.HtmlElement]:
+        """Return all pages of the `pdftotext -bbox-layout` output of the whole document, as xml elements."""
+        if self._bbox_pages is None:
+            # the output is parsed from bytes, saving its decoding into str and encoding back for libxml2
+            bbox_output = self.extract_bytes_from_pdf(pdftotext_layout_argument="-bbox-layout")
+            self._root = html.fromstring(bbox_output, parser=self.parser)
+            self._bbox_pages = PAGES_XPATH(self._root)
+        return self._bbox_pages
 
     def get_pages(self) -> Dict[int, List[html.HtmlElement]]:
         """Return a dictionary {page_num: list_of_words (as xml elements)}."""
-        res = {}
-        for page_idx in range(self.number_of_pages):
-            res[page_idx] = self.get_page_as_html(page_idx=page_idx).findall(".//word")
-        return res
+        return {page_idx: self._page_word_elements(page_idx) for page_idx in range(self.number_of_pages)}
+
+    def _page_word_elements(self, page_idx: int) -> List[html.HtmlElement]:
+        """Return words on a page as xml elements; the page is parsed and searched for words only once."""
+        if page_idx not in self._word_elements:
+            self._word_elements[page_idx] = WORDS_XPATH(self.get_page_as_html(page_idx=page_idx))
+        return self._word_elements[page_idx]
+
+    def get_page_word_boxes(self,
+                            page_idx: int,
+                            img_size: Optional[Tuple[int, int]] = None) -> Tuple[List[str], np.ndarray]:
+        """Return words on a page as strings, together with all their bounding boxes in one array.
+
+        :param page_idx: page number, starting from zero
+        :param img_size: if given as (img_width, img_height), boxes are converted into image coordinates
+        :return: list of words and an array of shape (n_words, 4) with columns x_min, y_min, x_max, y_max
+        """
+        texts = self._page_word_texts(page_idx)
+        boxes = self.get_bounding_boxes_of_elems(self._page_word_elements(page_idx))
+        if img_size is not None:
+            pdf_width, pdf_height = self.get_width_height(page_idx)
+            boxes = pdf_boxes_to_image_boxes(boxes, pdf_width, pdf_height, *img_size)
+        return texts, boxes
 
     def get_pages_as_text(self) -> Dict[int, List[str]]:
         """Return a dictionary {page_num : list_of_words (as strings)}."""
-        return {
-            page_nr: list(map(lambda w: w.text if w.text is not None else "", words))
-            for page_nr, words in self.get_pages().items()}
+        return {page_idx: self._page_word_texts(page_idx) for page_idx in range(self.number_of_pages)}
+
+    def _page_word_texts(self, page_idx: int) -> List[str]:
+        """Return words on a page as strings, taken from the cached word elements of the page."""
+        if page_idx not in self._word_texts:
+            self._word_texts[page_idx] = [
+                word.text if word.text is not None else "" for word in self._page_word_elements(page_idx)]
+        return self._word_texts[page_idx]
 
     def recreate_digital_content(self,
                                  output_pdf: str,
                                  images_dpi: int = 150,
                                  higher_dpi_for_scan: Optional[int] = None,
                                  tesseract_lang: str = "eng",
-                                 tesseract_conf: str = "") -> None:
+                                 tesseract_conf: str = "",
+                                 max_workers: Optional[int] = None) -> None:
         """Get images, do OCR and create a new pdf with new text layer.
 
         Can be useful for documents which are only images.
@@ -198,28 +445,26 @@ class Pdf:
         :param higher_dpi_for_scan: if not None, higher resolution image will be created for ocr only
         :param tesseract_lang: language to expect
         :param tesseract_conf: tesseract configuration
+        :param max_workers: number of processes rendering and doing ocr of pages, see `Scanner.images_to_ocred_pdf`
         """
-        temp_dir, pdf_paths = mkdtemp(), []
-        for page_idx in range(self.number_of_pages):
-            img = self.page_image(
-                page_idx=page_idx,
-                dpi=images_dpi,
-                recompute=True)  # this make take some time, but less than ocr
-            current_pdf_name = str(Path(temp_dir) / f"{page_idx}.pdf")
-            pdf_paths.append(current_pdf_name)
-            pdf_width, pdf_height = self.get_width_height(page_idx)
-            img_for_ocr = img
-            if higher_dpi_for_scan is not None:
-                if higher_dpi_for_scan < images_dpi:
-                    logger.warning("lower resolution is used for OCR than for insertion into the pdf; ocr can be bad")
-                img_for_ocr = self.page_image(page_idx, dpi=higher_dpi_for_scan, recompute=True)
-            ocr_text = Scanner.ocr_one_image(img_for_ocr, tesseract_lang, tesseract_conf)
-            Scanner.image_to_one_page_ocred_pdf(
-                img, current_pdf_name, pdf_width=pdf_width, pdf_height=pdf_height, ocr_text=ocr_text)
-
-        merge_pdfs(output_pdf, *pdf_paths)
-        # cleanup
-        shutil.rmtree(temp_dir)
+        # all pages are rendered by one pdf2image call, split among parallel pdftoppm processes
+        images = self.all_images(dpi=images_dpi, thread_count=max_workers)
+        pdf_sizes = [self.get_width_height(page_idx) for page_idx in range(self.number_of_pages)]
+
+        images_for_ocr = images
+        if higher_dpi_for_scan is not None:
+            if higher_dpi_for_scan < images_dpi:
+                logger.warning("lower resolution is used for OCR than for insertion into the pdf; ocr can be bad")
+            images_for_ocr = self._images_dpi_cache.get(higher_dpi_for_scan)
+            if images_for_ocr is None:
+                # used for ocr only, so not cached on the object, where they would hold a lot of memory
+                images_for_ocr = images_from_pdf(str(self.pdf_path), dpi=higher_dpi_for_scan, thread_count=max_workers)
+                for page_idx, img in enumerate(images_for_ocr):
+                    self._check_page_image(page_idx, img)
+
+        Scanner.images_to_ocred_pdf(
+            images, output_pdf, pdf_sizes, images_for_ocr=images_for_ocr,
+            lang=tesseract_lang, config=tesseract_conf, max_workers=max_workers)
 
     @staticmethod
     def get_bounding_box_of_elem(elem: html.HtmlElement) -> Rectangle:
@@ -230,14 +475,37 @@ class Pdf:
             x_max=elem.attrib["xmax"],
             y_max=elem.attrib["ymax"])
 
+    @staticmethod
+    def get_bounding_boxes_of_elems(elems: List[html.HtmlElement], dtype: type = np.float32) -> np.ndarray:
+        """Return coordinates of bounding boxes of many words, as an array of shape (n_words, 4)."""
+        boxes = np.empty((len(elems), 4), dtype=dtype)
+        for i, elem in enumerate(elems):
+            attrib = elem.attrib
+            boxes[i] = float(attrib["xmin"]), float(attrib["ymin"]), float(attrib["xmax"]), float(attrib["ymax"])
+        return boxes
+
     def __enter__(self):
         return self
 
     def __exit__(self, *exc):
-        self.__del__()
+        self.close()
 
     def __del__(self):
-        self.pdf_file.close()
+        self.close()
+
+    def close(self) -> None:
+        """Close the pdf file (and the PyMuPDF document); they are opened again if the pdf is used afterwards."""
+        self._close_reader()
+        if getattr(self, "_fitz_document", None) is not None:
+            self._fitz_document.close()
+            self._fitz_document = None
+
+    def _close_reader(self) -> None:
+        """Close the pdf file read by PyPDF2, after the reader is no longer needed; it is opened again on demand."""
+        if getattr(self, "pdf_file", None) is not None:  # opening the file may have failed in __init__
+            self.pdf_file.close()
+            self.pdf_file = None
+        self._pdf_reader = None
 
     def __repr__(self) -> str:
         return f"<Pdf object associated with {self.pdf_path}>"
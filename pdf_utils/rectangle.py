@@ -7,12 +7,16 @@ Main methods support various bounding-boxes operations such as
 from __future__ import annotations
 
 import logging
+from itertools import chain
+from operator import attrgetter
 from typing import Dict, List, Optional
 
 import numpy as np
 
 logger = logging.getLogger(__name__)
 
+_COORDINATES = attrgetter("x_min", "y_min", "x_max", "y_max")
+
 
 class Rectangle:
     """
@@ -21,6 +25,9 @@ class Rectangle:
     The need of this arose to remove ambiguity about what is width and what is height, in a 4-tuple.
     """
 
+    # no per-instance __dict__, rectangles are created for every word and every intersection of boxes
+    __slots__ = ("x_min", "y_min", "x_max", "y_max")
+
     def __init__(self, x_min, y_min, x_max, y_max, dtype=float) -> None:
         """Define ranges for x and y and compute width and height of the rectangle.
 
@@ -33,6 +40,16 @@ class Rectangle:
         if (self.x_min > self.x_max) or (self.y_min > self.y_max):
             logger.warning(f"rectangle lower bound is larger than upper bound (x: {x_min, x_max}, y: {y_min, y_max})")
 
+    @classmethod
+    def _from_valid(cls, x_min, y_min, x_max, y_max) -> Rectangle:
+        """Create a rectangle from coordinates known to be ordered, e.g. taken from other rectangles.
+
+        Internal fast path, without the conversion and the check of bounds done in `__init__`.
+        """
+        rect = cls.__new__(cls)
+        rect.x_min, rect.y_min, rect.x_max, rect.y_max = x_min, y_min, x_max, y_max
+        return rect
+
     @property
     def width(self):
         """Get width of the rectangle."""
@@ -45,8 +62,12 @@ class Rectangle:
 
     @property
     def area(self):
-        """Get area of the rectangle."""
-        return self.width * self.height
+        """Get area of the rectangle.
+
+        Computed from the coordinates directly, not through `width` and `height`. It is not cached, because
+        the coordinates are public attributes and a cached value would go stale when they are reassigned.
+        """
+        return (self.x_max - self.x_min) * (self.y_max - self.y_min)
 
     @property
     def center(self) -> tuple:
@@ -65,27 +86,50 @@ class Rectangle:
             "y_max": self.y_max,
         }
 
+    @property
+    def as_array(self) -> np.ndarray:
+        """Convert to an array of shape (4,) with x_min, y_min, x_max, y_max (one row of `boxes_to_array`)."""
+        return np.array(_COORDINATES(self), dtype=np.float64)
+
     @classmethod
     def from_dict(cls, rect_dict: Dict, dtype=float) -> Rectangle:
         """Create a rectangle from a dictionary.
 
         :param rect_dict: dictionary with keys 'x_min', 'y_min', 'x_max', 'y_max'.
         """
-        return Rectangle(**rect_dict, dtype=dtype)
+        return cls(rect_dict["x_min"], rect_dict["y_min"], rect_dict["x_max"], rect_dict["y_max"], dtype=dtype)
 
     def to_coco(self, rounding: Optional[int] = 2) -> Dict:
         """Convert to a dictionary with keys x_center, y_center, width, height.
 
         :param rounding: how many decimal places to use for the resulting floats
         """
-        x_center, y_center = self.center
+        x_center, y_center = (self.x_max + self.x_min) / 2, (self.y_max + self.y_min) / 2
+        width, height = self.x_max - self.x_min, self.y_max - self.y_min
+        if rounding is None:
+            return {"x_center": x_center, "y_center": y_center, "width": width, "height": height}
         return {
-            "x_center": x_center if rounding is None else round(x_center, rounding),
-            "y_center": y_center if rounding is None else round(y_center, rounding),
-            "width": self.width if rounding is None else round(self.width, rounding),
-            "height": self.height if rounding is None else round(self.height, rounding)
+            "x_center": round(x_center, rounding),
+            "y_center": round(y_center, rounding),
+            "width": round(width, rounding),
+            "height": round(height, rounding)
         }
 
+    @staticmethod
+    def to_coco_batch(boxes: np.ndarray, rounding: Optional[int] = 2) -> np.ndarray:
+        """Convert many boxes at once, as `to_coco` does one by one.
+
+        :param boxes: array of shape (N, 4) with columns x_min, y_min, x_max, y_max (see `boxes_to_array`)
+        :param rounding: how many decimal places to use for the resulting floats
+        :return: array of shape (N, 4) with columns x_center, y_center, width, height
+        """
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        coco = np.empty_like(boxes)
+        np.add(boxes[:, :2], boxes[:, 2:], out=coco[:, :2])
+        coco[:, :2] /= 2
+        np.subtract(boxes[:, 2:], boxes[:, :2], out=coco[:, 2:])
+        return coco if rounding is None else np.round(coco, rounding, out=coco)
+
     @classmethod
     def from_coco(cls, x_center, y_center, width, height) -> Rectangle:
         """Create a rectangle from center and width and height."""
@@ -107,15 +151,18 @@ class Rectangle:
     def rescale(self, multiply_width_by, multiply_height_by) -> Rectangle:
         """Multiplies horizontal and vertical ranges by constants."""
         return Rectangle(
-            x_min=self.x_min * multiply_width_by,
-            y_min=self.y_min * multiply_height_by,
-            x_max=self.x_max * multiply_width_by,
-            y_max=self.y_max * multiply_height_by
+            self.x_min * multiply_width_by,
+            self.y_min * multiply_height_by,
+            self.x_max * multiply_width_by,
+            self.y_max * multiply_height_by
         )
 
     def to_int(self) -> Rectangle:
-        """Create a new rectangle with all coordinats rounded to integers."""
-        return Rectangle(**self.as_dict, dtype=int)
+        """Create a new rectangle with all coordinats rounded to integers.
+
+        Truncation keeps the order of coordinates, so the new rectangle need not be checked again.
+        """
+        return Rectangle._from_valid(int(self.x_min), int(self.y_min), int(self.x_max), int(self.y_max))
 
     def relative_to_size(self, width, height) -> Rectangle:
         """Renormalizes rectangle coordinates relative to reference width and height.
@@ -127,48 +174,132 @@ class Rectangle:
     def intersection(self, other: Rectangle) -> Optional[Rectangle]:
         """Return interscetion Rectangle if nontrivial, else None."""
         x_min = max(self.x_min, other.x_min)
-        y_min = max(self.y_min, other.y_min)
         x_max = min(self.x_max, other.x_max)
+        if x_min > x_max:  # disjoint horizontally, the vertical range is not needed
+            return None
+        y_min = max(self.y_min, other.y_min)
         y_max = min(self.y_max, other.y_max)
-        if x_min > x_max or y_min > y_max:
+        if y_min > y_max:
             return None
-        return Rectangle(x_min=x_min, y_min=y_min, x_max=x_max, y_max=y_max)
+        return Rectangle._from_valid(x_min, y_min, x_max, y_max)
 
     def get_iou(self, rect: Rectangle) -> float:
-        """Compute intersection over union."""
-        inter = self.intersection(rect)
-        if not inter:
-            return 0
-        return inter.area / float(self.area + rect.area - inter.area)
+        """Compute intersection over union.
+
+        This is called for many pairs of rectangles, so it is written in plain arithmetic on the coordinates:
+        no intermediate tuples or properties, and boxes disjoint horizontally return before the vertical overlap.
+        For many pairs at once, see `iou_matrix`.
+        """
+        overlap_width = min(self.x_max, rect.x_max) - max(self.x_min, rect.x_min)
+        if overlap_width <= 0:
+            return 0.0
+        overlap_height = min(self.y_max, rect.y_max) - max(self.y_min, rect.y_min)
+        if overlap_height <= 0:
+            return 0.0
+        inter_area = overlap_width * overlap_height
+        self_area = (self.x_max - self.x_min) * (self.y_max - self.y_min)
+        rect_area = (rect.x_max - rect.x_min) * (rect.y_max - rect.y_min)
+        return inter_area / float(self_area + rect_area - inter_area)
+
+    @staticmethod
+    def boxes_to_array(rectangles: List[Rectangle], dtype=np.float64) -> np.ndarray:
+        """Convert rectangles into an array of shape (N, 4) with columns x_min, y_min, x_max, y_max.
+
+        The coordinates are streamed into one preallocated buffer, without a tuple or a row assignment per rectangle.
+
+        :param rectangles: rectangles to convert
+        :param dtype: dtype of the array; np.float32 halves the memory of the batch operations on large lists
+        """
+        coordinates = chain.from_iterable(map(_COORDINATES, rectangles))
+        return np.fromiter(coordinates, dtype=dtype, count=4 * len(rectangles)).reshape(-1, 4)
+
+    @staticmethod
+    def iou_matrix(boxes1: np.ndarray, boxes2: np.ndarray) -> np.ndarray:
+        """Compute intersection over union of all pairs of boxes at once.
+
+        :param boxes1: array of shape (N, 4) with columns x_min, y_min, x_max, y_max (see `boxes_to_array`)
+        :param boxes2: array of shape (M, 4), same columns
+        :return: array of shape (N, M); disjoint boxes have iou 0 (as in `get_iou`), and so do pairs of empty boxes.
+            It is float32 if both inputs are float32, float64 otherwise.
+        """
+        boxes1, boxes2 = np.asarray(boxes1), np.asarray(boxes2)
+        dtype = np.result_type(boxes1, boxes2, np.float32)
+        boxes1, boxes2 = boxes1.astype(dtype, copy=False), boxes2.astype(dtype, copy=False)
+        # overlaps computed in place in (N, M) buffers, without (N, M, 2) temporaries
+        inter = _overlaps(boxes1[:, 0], boxes1[:, 2], boxes2[:, 0], boxes2[:, 2])
+        inter *= _overlaps(boxes1[:, 1], boxes1[:, 3], boxes2[:, 1], boxes2[:, 3])
+        area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+        area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+        union = np.add.outer(area1, area2)
+        union -= inter
+        return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
 
     def smallest_common_superrectangle(self, other: Rectangle) -> Rectangle:
         """Return a rectangle containing both self and other."""
-        return Rectangle(
-            x_min=min(self.x_min, other.x_min),
-            y_min=min(self.y_min, other.y_min),
-            x_max=max(self.x_max, other.x_max),
-            y_max=max(self.y_max, other.y_max)
-        )
+        return Rectangle._from_valid(
+            min(self.x_min, other.x_min),
+            min(self.y_min, other.y_min),
+            max(self.x_max, other.x_max),
+            max(self.y_max, other.y_max))
 
     def intersection_width_some_other(self, others: List[Rectangle]) -> bool:
         """Return True if some of the other rectangles intersects this rectangle, False otherwise."""
-        return any(self.intersection(other) for other in others)
+        x_min, y_min, x_max, y_max = self.x_min, self.y_min, self.x_max, self.y_max
+        for other in others:
+            # the vertical ranges are compared only for rectangles overlapping horizontally
+            if other.x_min <= x_max and x_min <= other.x_max and other.y_min <= y_max and y_min <= other.y_max:
+                return True
+        return False
+
+    def any_intersects(self, boxes: np.ndarray) -> bool:
+        """Return True if some of the boxes intersects this rectangle (touching counts), False otherwise.
+
+        Array version of `intersection_width_some_other`, for many boxes at once.
+
+        :param boxes: array of shape (M, 4) with columns x_min, y_min, x_max, y_max (see `boxes_to_array`)
+        """
+        boxes = np.asarray(boxes).reshape(-1, 4)
+        overlap_x = (boxes[:, 0] <= self.x_max) & (boxes[:, 2] >= self.x_min)
+        overlap_y = (boxes[:, 1] <= self.y_max) & (boxes[:, 3] >= self.y_min)
+        return bool(np.any(overlap_x & overlap_y))
+
+    def contains_any(self, boxes: np.ndarray) -> bool:
+        """Return True if some of the boxes is a sub-rectangle of this rectangle (see `contains_other`).
+
+        :param boxes: array of shape (M, 4) with columns x_min, y_min, x_max, y_max (see `boxes_to_array`)
+        """
+        boxes = np.asarray(boxes).reshape(-1, 4)
+        inside_x = (boxes[:, 0] >= self.x_min) & (boxes[:, 2] <= self.x_max)
+        inside_y = (boxes[:, 1] >= self.y_min) & (boxes[:, 3] <= self.y_max)
+        return bool(np.any(inside_x & inside_y))
 
     @staticmethod
     def normalize_list_of_rectangles(rectangles: List[Rectangle]) -> List[Rectangle]:
-        """Recursively replaces intersecting rectangle pair by their lowest common superrectangle."""
+        """Replace groups of intersecting rectangles by their lowest common superrectangles.
+
+        Rectangles intersect if their iou is nonzero, i.e. if they overlap both horizontally and vertically
+        (no areas or divisions are needed to decide that). Groups of (transitively) intersecting rectangles are found
+        as connected components of the intersection graph, and each is replaced by one superrectangle;
+        this repeats until the superrectangles do not intersect each other.
+        Superrectangles are returned in the order of the first rectangle of each group.
+        """
         if len(rectangles) < 2:
             return rectangles
 
-        first = rectangles[0]
-
-        first_intersects_some = False
-        for i in range(1, len(rectangles)):
-            if first.get_iou(rectangles[i]):  # intersection nontrivial
-                rectangles[i] = rectangles[i].smallest_common_superrectangle(first)
-                first_intersects_some = True
-        rest_normalized = Rectangle.normalize_list_of_rectangles(rectangles[1:])
-        return rest_normalized if first_intersects_some else [first] + rest_normalized
+        boxes = Rectangle.boxes_to_array(rectangles)
+        while True:
+            # each pair once (first < second); no triangular copy of the (N, N) mask is made
+            first, second = np.nonzero(_overlap_mask(boxes))
+            upper = first < second
+            if not upper.any():
+                return [Rectangle._from_valid(*box) for box in boxes.tolist()]
+            # components are labeled by their smallest index, unique labels are thus sorted by the first rectangle
+            _, group = np.unique(_connected_components(len(boxes), first[upper], second[upper]), return_inverse=True)
+            merged = np.empty((group.max() + 1, 4))
+            merged[:, :2], merged[:, 2:] = np.inf, -np.inf
+            np.minimum.at(merged[:, :2], group, boxes[:, :2])
+            np.maximum.at(merged[:, 2:], group, boxes[:, 2:])
+            boxes = merged
 
     def __contains__(self, other: Rectangle) -> bool:
         """Check if the other box is a subbox of the current box.
@@ -179,10 +310,46 @@ class Rectangle:
             `Rectangle(1, 1, 2, 2) in Rectangle(0, 0, 5, 5)` is True, while
             `Rectangle(1, 1, 2, 2) in Rectangle(1, 1.1, 2, 3)` is False.
         """
-        return self.contains_other(other)
+        # the same as `contains_other`, written out to save a method call in the `in` operator
+        return other.x_min >= self.x_min and other.x_max <= self.x_max and (
+            other.y_min >= self.y_min and other.y_max <= self.y_max)
 
     def __eq__(self, other: Rectangle) -> bool:
         return self.as_dict == other.as_dict
 
     def __repr__(self) -> str:
         return f"<Rectangle(x_min={self.x_min}, y_min={self.y_min}, x_max={self.x_max}, y_max={self.y_max})>"
+
+
+def _overlaps(min1: np.ndarray, max1: np.ndarray, min2: np.ndarray, max2: np.ndarray) -> np.ndarray:
+    """Lengths of overlaps of all pairs of intervals [min1[i], max1[i]] and [min2[j], max2[j]], zero if disjoint."""
+    overlaps = np.minimum.outer(max1, max2)
+    overlaps -= np.maximum.outer(min1, min2)
+    return np.clip(overlaps, 0, None, out=overlaps)
+
+
+def _overlap_mask(boxes: np.ndarray) -> np.ndarray:
+    """Boolean (N, N) matrix of pairs of boxes with nonzero iou, i.e. with overlaps of positive length in both axes."""
+    mask = _overlaps(boxes[:, 0], boxes[:, 2], boxes[:, 0], boxes[:, 2]) > 0
+    mask &= _overlaps(boxes[:, 1], boxes[:, 3], boxes[:, 1], boxes[:, 3]) > 0
+    return mask
+
+
+def _connected_components(n: int, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """Label n nodes by connected components of the graph with edges (first[k], second[k]), by union-find.
+
+    Every node is labeled by the smallest node of its component.
+    """
+    parent = list(range(n))
+
+    def find(node: int) -> int:
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]  # path halving
+            node = parent[node]
+        return node
+
+    for i, j in zip(first.tolist(), second.tolist()):
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+    return np.array([find(node) for node in range(n)])
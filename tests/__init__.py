@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 
@@ -9,3 +10,6 @@ PDF_ROTATED_PATH = HERE / "data_git" / "example_rotated.pdf"
 
 FIRST_PDF_PAGE_PATH = HERE / "data_git" / "example_150-1.png"
 SECOND_PDF_PAGE_PATH = HERE / "data_git" / "example_150-2.png"
+
+# memory-backed folder for temporary pdfs written and read back within a test (on linux), default temp folder otherwise
+MEMORY_TMP_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
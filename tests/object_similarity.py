@@ -3,32 +3,100 @@
 In the tests, we often cannot strictly enforce equality of two images (one original and another one recreated somehow)
 up to the last pixel. The same is true for bounding boxes of pdf annotations.
 """
-from typing import Tuple
+from functools import lru_cache
+from pathlib import Path
+from typing import Sequence, Tuple, Union
 
 import cv2
 import numpy as np
-from scipy.stats import pearsonr
+from PIL import Image
 
 from pdf_utils.annotation import Annotation
+from pdf_utils.rectangle import Rectangle
 
 
-def naive_image_similarity(im1: np.ndarray, im2: np.ndarray, kernel: Tuple = (7, 7)) -> float:
+def naive_image_similarity(im1: Union[np.ndarray, Path],
+                           im2: Union[np.ndarray, Path],
+                           kernel: Tuple = (7, 7),
+                           size: Tuple[int, int] = (256, 256)) -> float:
     """Naive similarity of two images, represented as 2- or 3-dimensional numpy arrays.
 
-    We first apply a Gaussian filter, then flatten the images and return Pearsson correlation.
+    We first apply a Gaussian filter, downsample both images to a fixed size, and return their Pearsson correlation.
 
     (Applying Gaussian filter brings some spatial information into the correlation.)
+    Reference images can be given by their paths, they are then loaded, blurred and downsampled only once per test run.
+
+    :param kernel: size of the Gaussian filter, applied in full resolution
+    :param size: (width, height) both images are downsampled to, by averaging pixel areas
     """
-    # convert to grayscale, if not yet
-    if im1.ndim == 3:
-        im1 = cv2.cvtColor(im1, cv2.COLOR_RGB2GRAY)
-    if im2.ndim == 3:
-        im2 = cv2.cvtColor(im2, cv2.COLOR_RGB2GRAY)
+    return _pearson(_prepared(im1, kernel, size), _prepared(im2, kernel, size))
+
+
+def _prepared(im: Union[np.ndarray, Path], kernel: Tuple, size: Tuple[int, int]) -> np.ndarray:
+    """Blurred and downsampled image as a new float32 array (which `_pearson` may modify)."""
+    if isinstance(im, Path):
+        return _prepared_reference(str(im), kernel, size).copy()
+    return _downsampled(_blurred(im, kernel), size)
+
 
-    im1 = cv2.GaussianBlur(im1, kernel, cv2.BORDER_DEFAULT)
-    im2 = cv2.GaussianBlur(im2, kernel, cv2.BORDER_DEFAULT)
+def _downsampled(im: np.ndarray, size: Tuple[int, int]) -> np.ndarray:
+    """Resize the (already blurred) image to a fixed size, so that the correlation works on few pixels."""
+    return cv2.resize(im, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+def _pearson(x: np.ndarray, y: np.ndarray) -> float:
+    """Pearson correlation of two arrays of the same shape, without the p-value we don't need.
+
+    The arrays are centered in place (callers pass fresh arrays) and the sums of products are dot products,
+    so no temporary arrays are created.
+    """
+    x, y = x.ravel(), y.ravel()
+    x -= x.mean()
+    y -= y.mean()
+    return float(np.dot(x, y) / np.sqrt(np.dot(x, x) * np.dot(y, y)))
 
-    return pearsonr(im1.flatten(), im2.flatten())[0]
+
+def _blurred(im: np.ndarray, kernel: Tuple) -> np.ndarray:
+    """Convert the image to grayscale, if not yet, and apply Gaussian filter."""
+    if im.ndim == 3:
+        im = cv2.cvtColor(im, cv2.COLOR_RGB2GRAY)
+    kernel_x, kernel_y = _gaussian_kernel(kernel[0]), _gaussian_kernel(kernel[1])
+    return cv2.sepFilter2D(im, -1, kernel_x, kernel_y, borderType=cv2.BORDER_DEFAULT)
+
+
+@lru_cache(maxsize=None)
+def _gaussian_kernel(size: int) -> np.ndarray:
+    """One-dimensional Gaussian kernel of given size, the same one GaussianBlur would compute on each call."""
+    kernel = cv2.getGaussianKernel(size, 0).astype(np.float32)
+    kernel.flags.writeable = False
+    return kernel
+
+
+@lru_cache(maxsize=None)
+def _prepared_reference(path: str, kernel: Tuple, size: Tuple[int, int]) -> np.ndarray:
+    """Load a reference image from disc, blur and downsample it, cached for all tests comparing with it."""
+    prepared = _downsampled(_blurred(reference_image(Path(path)), kernel), size)
+    prepared.flags.writeable = False  # shared by all callers
+    return prepared
+
+
+@lru_cache(maxsize=None)
+def reference_image(path: Path) -> np.ndarray:
+    """Load and decode a reference image from disc once per test run, as a read-only numpy array.
+
+    The image is decoded by OpenCV (faster than PIL for large pngs) and its channels are reordered to RGB(A),
+    so the array is the same as `np.asarray(Image.open(path))`.
+    """
+    image = cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB if image.shape[2] == 3 else cv2.COLOR_BGRA2RGBA)
+    image.flags.writeable = False  # shared by all callers
+    return image
+
+
+def images_are_equal(im1: Image.Image, im2: Image.Image) -> bool:
+    """Pixel-exact equality of two PIL images, compared as raw bytes (one memcmp instead of PIL's `__eq__`)."""
+    return im1.size == im2.size and im1.mode == im2.mode and im1.tobytes() == im2.tobytes()
 
 
 def annotations_are_similar(first: Annotation, second: Annotation, similarity_threshold: float = 0.99) -> bool:
@@ -39,4 +107,35 @@ def annotations_are_similar(first: Annotation, second: Annotation, similarity_th
         first.text_content == second.text_content) and (
         first.label == second.label) and (
         first.who_annotated == second.who_annotated) and (
-        first.box.get_iou(second.box) > similarity_threshold)
+        _boxes_are_similar(first.box, second.box, similarity_threshold))
+
+
+def similarity_matrix(annotations: Sequence[Annotation], others: Sequence[Annotation],
+                      similarity_threshold: float = 0.99) -> np.ndarray:
+    """Boolean matrix of shape (N, M), True where `annotations_are_similar(annotations[i], others[j])`.
+
+    Attributes are compared by their (hashable) `similarity_key`, ious of all pairs of boxes are computed at once.
+    """
+    keys = [similarity_key(annot) for annot in annotations]
+    other_keys = [similarity_key(annot) for annot in others]
+    same_attributes = np.array([[key == other_key for other_key in other_keys] for key in keys], dtype=bool)
+    ious = Rectangle.iou_matrix(Rectangle.boxes_to_array([annot.box for annot in annotations]),
+                                Rectangle.boxes_to_array([annot.box for annot in others]))
+    return same_attributes.reshape(ious.shape) & (ious > similarity_threshold)
+
+
+def similarity_key(annot: Annotation) -> Tuple:
+    """Attributes of the annotation that must be equal for annotations to be similar."""
+    return annot.page, annot.type, annot.text_content, annot.label, annot.who_annotated
+
+
+def _boxes_are_similar(first: Rectangle, second: Rectangle, similarity_threshold: float) -> bool:
+    """Check that iou of the boxes exceeds the threshold, without computing it for boxes of too different areas.
+
+    The iou is at most the ratio of the smaller area to the larger one (the intersection is at most the smaller box,
+    the union at least the larger one). Boxes disjoint along an axis are rejected by `get_iou` itself.
+    """
+    first_area, second_area = first.area, second.area
+    if min(first_area, second_area) <= similarity_threshold * max(first_area, second_area):
+        return False
+    return first.get_iou(second) > similarity_threshold
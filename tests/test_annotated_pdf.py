@@ -2,26 +2,35 @@ import os
 import re
 import unittest
 from tempfile import mkstemp
+from unittest.mock import patch
 
 import numpy as np
-from PIL import Image
 
+from pdf_utils import annotated_pdf, converter
 from pdf_utils.annotated_pdf import AnnotatedPdf
 from pdf_utils.annotation import AnnotationExtractor
 from pdf_utils.pdf_handler import Pdf
+from pdf_utils.rectangle import Rectangle
 from tests import ANNOTATED_PDF_PATH, FIRST_PDF_PAGE_PATH, PDF_PATH
-from tests.object_similarity import annotations_are_similar, naive_image_similarity
+from tests.object_similarity import annotations_are_similar, naive_image_similarity, reference_image
 
 
 class TestAnnotatedPdf(unittest.TestCase):
 
-    annotated_pdf = AnnotatedPdf(ANNOTATED_PDF_PATH)
-    extracted_annots = AnnotationExtractor.get_annot_from_pdf(annotated_pdf)
-
     risk_pattern = re.compile(r"Being\s+killed\s+at\s+train\s+station")
     deductible_pattern = re.compile(r"1\s?%")
     currency_pattern = re.compile(r"Euro")
 
+    @classmethod
+    def setUpClass(cls) -> None:
+        # shared by all tests; annotations (raw and enriched) and flows are computed once and cached in the instance
+        cls.annotated_pdf = AnnotatedPdf(ANNOTATED_PDF_PATH)
+        cls.extracted_annots = AnnotationExtractor.get_annot_from_pdf(cls.annotated_pdf)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.annotated_pdf.close()
+
     def test_raw_annotations(self):
         """Check that the raw_annotations extracted from AnnotatedPdf coincides with what AnnotationExtractor returns.
 
@@ -51,11 +60,95 @@ class TestAnnotatedPdf(unittest.TestCase):
         # check that the 'scores' of words in first rectangle annotation are reasonable
         for i, w in enumerate(enriched[0]["words"]):
             word_bb = Pdf.get_bounding_box_of_elem(w["word"])
+            self.assertEqual(w["bounding_box"], word_bb)
             self.assertGreater(w["score"], 0.9)
 
-            self.assertLess(
-                word_bb.intersection(rectangle_annots[0].box).area / word_bb.area - w["score"],
-                0.01)
+            # scores are computed in double precision, as with Rectangles
+            self.assertAlmostEqual(
+                word_bb.intersection(rectangle_annots[0].box).area / word_bb.area, w["score"], places=12)
+
+    def test_page_structures_built_once_per_page(self):
+        """Word boxes and their spatial index are built once per annotated page, not once per annotation or word."""
+        pdf = AnnotatedPdf(ANNOTATED_PDF_PATH)
+        with patch.object(annotated_pdf, "_SweepIndex", wraps=annotated_pdf._SweepIndex) as word_index, \
+                patch.object(Pdf, "get_bounding_box_of_elem") as box_of_word:
+            enriched = pdf.enriched_annotations
+        pages = {annot["annotation"].page for annot in enriched}
+        self.assertGreater(len(enriched), len(pages))
+        self.assertEqual(word_index.call_count, len(pages))
+        # boxes of matched words come from the boxes parsed with the page, attributes are not parsed again
+        box_of_word.assert_not_called()
+
+    def test_words_grouped_by_flows_and_pages(self):
+        """Words collected once per flow and page are grouped exactly as searching every flow and page would."""
+        pdf = self.annotated_pdf
+        pdf._collect_flows()
+        self.assertEqual(pdf._flows_as_html, [flow for page in pdf._pages_as_html for flow in page.findall(".//flow")])
+        for flow_id, flow in enumerate(pdf._flows_as_html):
+            self.assertEqual(pdf._words_of_flow[flow_id], flow.findall(".//word"))
+            self.assertEqual(pdf._flow_words_as_text(flow_id), [word.text for word in flow.findall(".//word")])
+        for page_idx, page in enumerate(pdf._pages_as_html):
+            self.assertEqual(pdf._words_of_page[page_idx], page.findall(".//word"))
+
+    def test_word_index_query(self):
+        """The spatial index of word boxes finds the same boxes as a full scan, touching boxes included."""
+        page_words = self.annotated_pdf._page_words(0)
+        boxes = page_words.boxes
+        queries = [annot.box for annot in self.extracted_annots if annot.page == 0]
+        queries.append(Rectangle(*boxes[0]))  # touches its neighbours on the same line
+        for rect in queries:
+            overlap_x = (boxes[:, 0] <= rect.x_max) & (boxes[:, 2] >= rect.x_min)
+            overlap_y = (boxes[:, 1] <= rect.y_max) & (boxes[:, 3] >= rect.y_min)
+            expected = np.flatnonzero(overlap_x & overlap_y)
+            np.testing.assert_array_equal(page_words.index.query(rect), expected)
+
+    def test_neighborhood_of_words(self):
+        """Words are located within their flow by lookup, words from different flows have no neighborhood."""
+        pdf = self.annotated_pdf
+        pdf._collect_flows()
+        first_flow_words, second_flow_words = pdf._words_of_flow[0], pdf._words_of_flow[1]
+
+        neighborhood = pdf._get_neighborhood_of_words([first_flow_words[2], first_flow_words[1], first_flow_words[2]])
+        self.assertIs(neighborhood["flow"], pdf._flows_as_html[0])
+        self.assertEqual(neighborhood["flow_id"], 0)
+        self.assertEqual(neighborhood["indices"], [1, 2])
+        self.assertEqual(neighborhood["words"], [w.text for w in first_flow_words])
+
+        self.assertIsNone(pdf._get_neighborhood_of_words([first_flow_words[0], second_flow_words[0]]))
+
+        # words with a gap between them keep their neighborhood, with a warning
+        with self.assertLogs(annotated_pdf.logger, level="WARNING") as logs:
+            neighborhood = pdf._get_neighborhood_of_words([first_flow_words[0], first_flow_words[2]])
+        self.assertEqual(neighborhood["indices"], [0, 2])
+        self.assertIn("not connected", logs.output[0])
+
+    def test_annotation_image_boxes(self):
+        """Check that annotation boxes of a page converted at once agree with the one-box conversion."""
+        img_size = self.annotated_pdf.page_image(0).size
+        annotations, boxes = self.annotated_pdf.get_annotation_image_boxes(0, img_size)
+
+        self.assertEqual(annotations, [annot for annot in self.annotated_pdf.raw_annotations if annot.page == 0])
+        self.assertEqual(boxes.shape, (len(annotations), 4))
+        for annot, box in zip(annotations, boxes):
+            self.assertEqual(
+                Rectangle(*box, dtype=int),
+                converter.pdf_box_to_image_box(annot.box, *self.annotated_pdf.get_width_height(0), *img_size))
+
+    def test_flows_collected_on_first_use(self):
+        """Raw annotations are extracted without running pdftotext, flows are collected once when needed."""
+        # patched on the class, as the pdf is created inside; autospec passes the instance on to the real method
+        with patch.object(AnnotatedPdf, "_run_pdftotext", autospec=True,
+                          side_effect=AnnotatedPdf._run_pdftotext) as run_pdftotext:
+            pdf = AnnotatedPdf(ANNOTATED_PDF_PATH)
+            self.assertEqual(len(pdf.raw_annotations), len(self.extracted_annots))
+            run_pdftotext.assert_not_called()
+
+            self.assertEqual(pdf.number_of_words, self.annotated_pdf.number_of_words)
+            flows_as_html = pdf._flows_as_html
+            pdf.get_flows_with_annotations()
+        self.assertIs(pdf._flows_as_html, flows_as_html)
+        self.assertEqual(run_pdftotext.call_count, 1)
+        self.assertIs(run_pdftotext.call_args[0][0], pdf)
 
     def test_pdf_with_no_anno(self):
         """Check that annotation lists are empty for a pdf with no annotations."""
@@ -63,6 +156,14 @@ class TestAnnotatedPdf(unittest.TestCase):
         self.assertListEqual(pdf_no_annot.raw_annotations, [])
         self.assertListEqual(pdf_no_annot.enriched_annotations, [])
 
+    def test_flows_of_pdf_with_no_anno(self):
+        """Flows of a pdf with no annotations are returned without annotated indices, without matching words."""
+        pdf_no_annot = AnnotatedPdf(PDF_PATH)
+        flows = pdf_no_annot.get_flows_with_annotations()
+        self.assertTrue(flows)
+        self.assertTrue(all(flow["annotated_indices"] == {} for flow in flows.values()))
+        self.assertIsNone(pdf_no_annot._enriched_annotations)
+
     def test_annotated_flows(self):
         """Test annotated flows extracted from pre-defined document.
 
@@ -105,6 +206,21 @@ class TestAnnotatedPdf(unittest.TestCase):
                 elif k == "c":
                     self.assertTrue(self.currency_pattern.search(annotated_text))
 
+    def test_annotation_removal_backends(self):
+        """Annotations are removed with pikepdf (if installed) and with PyPDF2, the text content is kept."""
+        fd, temp_pdf_file = mkstemp(suffix=".pdf")
+        os.close(fd)
+        self.addCleanup(os.remove, temp_pdf_file)
+        for backend, pikepdf in (("pikepdf", annotated_pdf.pikepdf), ("pypdf2", None)):
+            with self.subTest(backend=backend), patch.object(annotated_pdf, "pikepdf", pikepdf):
+                if backend == "pikepdf" and pikepdf is None:
+                    self.skipTest("pikepdf is not installed")
+                self.annotated_pdf.remove_annotations_and_save(temp_pdf_file)
+                with AnnotatedPdf(temp_pdf_file) as pdf_no_annots:
+                    self.assertListEqual(pdf_no_annots.raw_annotations, [])
+                    self.assertEqual(pdf_no_annots.number_of_pages, self.annotated_pdf.number_of_pages)
+                    self.assertEqual(pdf_no_annots.get_pages_as_text(), self.annotated_pdf.get_pages_as_text())
+
     def test_annotation_removal(self):
         """Remove all annotation and test consistency."""
         temp_pdf_file = mkstemp()[1]
@@ -116,11 +232,11 @@ class TestAnnotatedPdf(unittest.TestCase):
 
         # first page should look similar than the reference page
         first_page_no_anno = pdf_no_annots.page_image(0, dpi=150)
-        first_im_ref = Image.open(str(FIRST_PDF_PAGE_PATH))
+        ref_height, ref_width = reference_image(FIRST_PDF_PAGE_PATH).shape[:2]
         self.assertGreater(
             naive_image_similarity(
-                np.array(first_im_ref),
-                np.array(first_page_no_anno.resize(first_im_ref.size))),
+                FIRST_PDF_PAGE_PATH,
+                np.asarray(first_page_no_anno.resize((ref_width, ref_height)))),
             0.99
         )
 
@@ -1,21 +1,25 @@
+import io
 import json
 import os
+import pickle
 import unittest
 from tempfile import mkstemp
+from types import GeneratorType
+from unittest.mock import patch
 
+from pdf_utils import annotation
 from pdf_utils.annotation import Annotation, AnnotationExtractor
 from pdf_utils.pdf_handler import Pdf
 from pdf_utils.rectangle import Rectangle
 from tests import ANNOTATED_PDF_PATH
-from tests.object_similarity import annotations_are_similar
+from tests.object_similarity import annotations_are_similar, similarity_matrix
 
 
 class TestAnnotation(unittest.TestCase):
 
-    annotated_pdf = Pdf(ANNOTATED_PDF_PATH)
     extractor = AnnotationExtractor()
 
-    expected_annotations = [
+    expected_annotations = (
         Annotation(
             page=0,
             type="note",
@@ -52,7 +56,14 @@ class TestAnnotation(unittest.TestCase):
             box=Rectangle(x_min=55.7, y_min=133.72, x_max=338.9, y_max=177.23),
             text_content="add Honza",
             who_annotated="peter"),
-    ]
+    )
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        # opened when the tests run, not when the module is imported;
+        # the tests only read the extracted annotations, they are extracted once for all of them
+        cls.annotated_pdf = Pdf(ANNOTATED_PDF_PATH)
+        cls.annotations = cls.extractor.get_annot_from_pdf(cls.annotated_pdf)
 
     def test_assertion_in_annotation_type(self):
         """If type is not in ADMISSIBLE_ANNOTATIONS, an error should be raised."""
@@ -60,6 +71,12 @@ class TestAnnotation(unittest.TestCase):
             AssertionError,
             lambda: Annotation(page=0, type="invisible", box=Rectangle(0, 0, 0, 0)))
 
+    def test_admissible_types_extendable(self):
+        """Users can extend the admissible annotation types in place."""
+        annotation.ADMISSIBLE_ANNOTATION_TYPES.add("square")
+        self.addCleanup(annotation.ADMISSIBLE_ANNOTATION_TYPES.discard, "square")
+        self.assertEqual(Annotation(page=0, type="square", box=Rectangle(0, 0, 1, 1)).type, "square")
+
     def test_annotation_creation(self):
         """Test the creation of one Annotation object."""
         ann = Annotation(
@@ -84,30 +101,111 @@ class TestAnnotation(unittest.TestCase):
 
         self.assertEqual(ann.as_dict, expected_annotation_as_dict)
 
+    def test_annotation_pickling(self):
+        """Annotations have slots only, they must survive pickling (used by the parallel extraction)."""
+        ann = Annotation(page=1, type="ovál", box=Rectangle(1, 2, 3, 4), text_content="x", label=2)
+        self.assertFalse(hasattr(ann, "__dict__"))
+        self.assertEqual(pickle.loads(pickle.dumps(ann)).as_dict, ann.as_dict)
+
     def test_annotation_extraction(self):
         """Extract annotation from file and check that they correspond to expected annotations."""
-        annotations = self.extractor.get_annot_from_pdf(self.annotated_pdf)
+        annotations = self.annotations
 
+        # all pairs of annotations compared at once
+        similar = similarity_matrix(annotations, self.expected_annotations)
         # each annotation is found in expected
-        for annot in annotations:
+        for annot, found in zip(annotations, similar.any(axis=1)):
             with self.subTest(annotation=annot):
-                self.assertTrue(
-                    any(annotations_are_similar(annot, other)
-                        for other in self.expected_annotations))
+                self.assertTrue(found)
         # each expected annotation is found in annotations
-        for exp_annot in self.expected_annotations:
+        for exp_annot, found in zip(self.expected_annotations, similar.any(axis=0)):
             with self.subTest(expected_annotation=exp_annot):
-                self.assertTrue(
-                    any(annotations_are_similar(exp_annot, other)
-                        for other in annotations))
+                self.assertTrue(found)
+
+    def test_iter_annotations(self):
+        """The lazy iterator should yield the same annotations as get_annot_from_pdf, in the same order."""
+        annotations = self.annotations
+        iterated = self.extractor.iter_annotations(self.annotated_pdf)
+
+        self.assertIsInstance(iterated, GeneratorType)
+        iterated = list(iterated)
+        self.assertEqual(len(annotations), len(iterated))
+        for annot, other in zip(annotations, iterated):
+            self.assertTrue(annotations_are_similar(annot, other))
+
+    def test_parsed_pages_are_memoized(self):
+        """A second extraction from the same Pdf object should not parse the pdf pages again."""
+        pdf = Pdf(ANNOTATED_PDF_PATH)
+        annotations = self.extractor.get_annot_from_pdf(pdf)
+        with patch.object(AnnotationExtractor, "_parse_annot_pdf_page") as parse_page:
+            annotations_again = self.extractor.get_annot_from_pdf(pdf)
+        parse_page.assert_not_called()
+        self.assertIsNone(pdf.pdf_file)  # closed after the pages are parsed
+        self.assertEqual([annot.as_dict for annot in annotations], [annot.as_dict for annot in annotations_again])
+
+        # every extraction gets its own objects, changes made by one caller are not seen by the others
+        annotations[0].label = 7
+        annotations[0].box.x_min = -1.0
+        annotations_again = self.extractor.get_annot_from_pdf(pdf)
+        self.assertIsNone(annotations_again[0].label)
+        self.assertGreaterEqual(annotations_again[0].box.x_min, 0)
+
+    def test_parallel_annotation_extraction(self):
+        """Parsing pages in worker processes should give the same annotations as the sequential parsing."""
+        annotations = self.extractor.get_annot_from_pdf(self.annotated_pdf, num_workers=1)
+        with patch.object(AnnotationExtractor, "parallel_min_pages", 1):
+            # a fresh Pdf object, pages of self.annotated_pdf are already parsed and memoized
+            annotations_parallel = self.extractor.get_annot_from_pdf(Pdf(ANNOTATED_PDF_PATH), num_workers=2)
+
+        self.assertEqual(len(annotations), len(annotations_parallel))
+        for annot, other in zip(annotations, annotations_parallel):
+            self.assertTrue(annotations_are_similar(annot, other))
+
+        # pages memoized before the parallel parsing are kept
+        pdf = Pdf(ANNOTATED_PDF_PATH)
+        next(self.extractor.iter_annotations(pdf))
+        first_page = annotation._parsed_pages[pdf][0]
+        with patch.object(AnnotationExtractor, "parallel_min_pages", 1):
+            annotations_parallel = self.extractor.get_annot_from_pdf(pdf, num_workers=2)
+        self.assertIs(annotation._parsed_pages[pdf][0], first_page)
+        self.assertEqual(len(annotations), len(annotations_parallel))
+
+    def test_no_worker_processes_by_default_without_fork(self):
+        """Where processes are spawned, worker processes are used only if `num_workers` is given explicitly."""
+        with patch.object(AnnotationExtractor, "parallel_min_pages", 1), \
+                patch.object(annotation.multiprocessing, "get_start_method", return_value="spawn"), \
+                patch.object(annotation, "ProcessPoolExecutor") as pool:
+            annotations = self.extractor.get_annot_from_pdf(Pdf(ANNOTATED_PDF_PATH))
+        pool.assert_not_called()
+        self.assertEqual(len(annotations), len(self.annotations))
+
+    @unittest.skipIf(annotation.fitz is None, "PyMuPDF is not installed")
+    def test_annotation_extraction_with_fitz(self):
+        """Annotations read by PyMuPDF should be the same as the ones read by PyPDF2."""
+        annotations = self.annotations
+        annotations_fitz = self.extractor.get_annot_from_pdf(self.annotated_pdf, backend="pymupdf")
+
+        self.assertEqual(len(annotations), len(annotations_fitz))
+        for annot, annot_fitz in zip(annotations, annotations_fitz):
+            with self.subTest(annotation=annot):
+                self.assertTrue(annotations_are_similar(annot, annot_fitz))
+
+    def test_group_by_pages(self):
+        """Annotations are grouped by page, keeping their order within a page, also for unsorted input."""
+        annotations = [Annotation(page=page, type="note", box=Rectangle(i, i, i + 1, i + 1))
+                       for i, page in enumerate([2, 0, 2, 1, 0])]
+        grouped = self.extractor._group_by_pages(annotations)
+        self.assertEqual(list(grouped), [0, 1, 2])
+        self.assertEqual(grouped[2], [annotations[0], annotations[2]])
+        self.assertEqual(grouped[0], [annotations[1], annotations[4]])
+        self.assertEqual(self.extractor._group_by_pages(sorted(annotations, key=lambda a: a.page)), grouped)
 
     def test_dump_annotations_to_file(self):
         """Dump annotations to file, load them from file, and compare that all is consistent."""
-        annotations = self.extractor.get_annot_from_pdf(self.annotated_pdf)
-        temp_json_file = mkstemp()[1]
-        self.extractor.dump_annotations_to_file(annotations, temp_json_file)
-        with open(temp_json_file) as f:
-            annots_from_file = json.load(f)
+        annotations = self.annotations
+        stream = io.StringIO()
+        self.extractor.dump_annotations_to_file(annotations, stream)
+        annots_from_file = json.loads(stream.getvalue())
 
         for i, annot in enumerate(annots_from_file):
             # check that i'th annotation on page page_idx is the same in annotations and in annots_from_file
@@ -123,4 +221,39 @@ class TestAnnotation(unittest.TestCase):
                             label=annot["label"]),
                         annotations[i]))
 
+        # the same json is written without orjson, and into a file given by its path
+        with patch.object(annotation, "orjson", None):
+            stream = io.StringIO()
+            self.extractor.dump_annotations_to_file(annotations, stream)
+        self.assertEqual(json.loads(stream.getvalue()), annots_from_file)
+        temp_json_file = mkstemp()[1]
+        self.extractor.dump_annotations_to_file(annotations, temp_json_file)
+        with open(temp_json_file) as f:
+            self.assertEqual(json.load(f), annots_from_file)
         os.remove(temp_json_file)
+
+    def test_json_with_and_without_orjson(self):
+        """The json module writes the same json as orjson, except for NaN, which orjson writes as null."""
+        ann = Annotation(page=0, type="ovál", box=Rectangle(1, 2, 3, 4), text_content="žluťoučký kůň")
+        ann_nan = Annotation(page=0, type="note", box=Rectangle(1, 2, 3, float("nan")))
+        fd, temp_json_file = mkstemp(suffix=".json")
+        os.close(fd)
+        self.addCleanup(os.remove, temp_json_file)
+
+        outputs = {}
+        for orjson in (annotation.orjson, None):
+            with self.subTest(orjson=orjson is not None), patch.object(annotation, "orjson", orjson):
+                self.extractor.dump_annotations_to_file([ann], temp_json_file)
+                with open(temp_json_file, "rb") as f:
+                    dumped = f.read()
+                stream = io.StringIO()
+                self.extractor.dump_annotations_to_file([ann_nan], stream)
+                outputs[orjson is not None] = repr(ann), dumped, stream.getvalue()
+
+                self.assertIn("žluťoučký kůň", repr(ann))
+                self.assertEqual(dumped.decode("utf-8"), f"[{repr(ann)}]")
+                self.assertEqual(json.loads(dumped), [ann.as_dict])
+                self.assertIn('"y_max":null' if orjson is not None else '"y_max":NaN', stream.getvalue())
+
+        if annotation.orjson is not None:
+            self.assertEqual(outputs[True][:2], outputs[False][:2])
@@ -2,25 +2,61 @@ import os
 import re
 import unittest
 from tempfile import mkstemp
+from unittest.mock import patch
 
+import cv2
 import numpy as np
 from PIL import Image
+from PyPDF2 import PdfFileReader
 
 from pdf_utils import converter
 from pdf_utils.rectangle import Rectangle
-from tests import FIRST_PDF_PAGE_PATH, PDF_PATH, SECOND_PDF_PAGE_PATH
-from tests.object_similarity import naive_image_similarity
+from tests import FIRST_PDF_PAGE_PATH, PDF_PATH, PDF_ROTATED_PATH, SECOND_PDF_PAGE_PATH
+from tests.object_similarity import naive_image_similarity, reference_image
 
 
 class TestRectangle(unittest.TestCase):
 
     def test_image_from_pdf_page(self):
         """Convert a pdf page to image."""
-        im_1 = np.array(Image.open(str(FIRST_PDF_PAGE_PATH)))
+        im_1 = reference_image(FIRST_PDF_PAGE_PATH)
         im_from_pdf = converter.image_from_pdf_page(PDF_PATH, page_num=0, dpi=150, return_numpy=True)
 
         self.assertEqual(im_1.shape, im_from_pdf.shape)
-        self.assertGreater(naive_image_similarity(im_1, im_from_pdf), 0.98)
+        self.assertGreater(naive_image_similarity(FIRST_PDF_PAGE_PATH, im_from_pdf), 0.98)
+        # mean absolute difference of pixels (in gray levels); cv2.norm does not wrap around like uint8 subtraction
+        self.assertLess(cv2.norm(im_1, np.ascontiguousarray(im_from_pdf), cv2.NORM_L1) / im_1.size, 8)
+
+    @unittest.skipIf(converter.fitz is None, "PyMuPDF is not installed")
+    def test_image_from_pdf_page_with_fitz(self):
+        """In-process rendering by PyMuPDF gives the same image as pdftoppm."""
+        im_poppler = converter.image_from_pdf_page(PDF_PATH, page_num=0, dpi=150, return_numpy=True)
+        im_fitz = converter.image_from_pdf_page(PDF_PATH, page_num=0, dpi=150, return_numpy=True, backend="pymupdf")
+
+        self.assertLessEqual(np.abs(np.array(im_fitz.shape) - np.array(im_poppler.shape)).max(), 1)
+        self.assertGreater(naive_image_similarity(im_fitz[:im_poppler.shape[0], :im_poppler.shape[1]],
+                                                  im_poppler[:im_fitz.shape[0], :im_fitz.shape[1]]), 0.95)
+
+    def test_rotated_image_from_pdf_page(self):
+        """Rotation of numpy output by multiples of 90 degrees agrees with rotation of the PIL image."""
+        for rotate_by in (90, 180, 270, -90, 45):
+            with self.subTest(rotate_by=rotate_by):
+                img = converter.image_from_pdf_page(
+                    PDF_PATH, page_num=0, dpi=36, return_numpy=False, rotate_by=rotate_by)
+                img_array = converter.image_from_pdf_page(PDF_PATH, page_num=0, dpi=36, rotate_by=rotate_by)
+                np.testing.assert_array_equal(img_array, np.asarray(img))
+
+    def test_images_from_pdf(self):
+        """Render all pages at once (in two pdftoppm processes), pages should match single-page rendering."""
+        images = converter.images_from_pdf(PDF_PATH, dpi=72, thread_count=2)
+        self.assertEqual(len(images), 2)
+        for page_num, img in enumerate(images):
+            single_page = converter.image_from_pdf_page(PDF_PATH, page_num=page_num, dpi=72, return_numpy=True)
+            self.assertGreater(naive_image_similarity(np.asarray(img), single_page), 0.98)
+
+        last_page = converter.images_from_pdf(PDF_PATH, dpi=72, first_page=1, last_page=1)
+        self.assertEqual(len(last_page), 1)
+        self.assertEqual((last_page[0].size, last_page[0].mode), (images[1].size, images[1].mode))
 
     def test_pdf_box_to_image_box(self):
         """Transform bounding box from points to pixels.
@@ -41,6 +77,29 @@ class TestRectangle(unittest.TestCase):
             converter.pdf_box_to_image_box,
             pdf_box=pdf_box, pdf_width=50, pdf_height=100, img_width=1000, img_height=500)
 
+        # the vertical scale follows the heights, not the widths
+        self.assertEqual(
+            converter.pdf_box_to_image_box(
+                pdf_box=pdf_box, pdf_width=50, pdf_height=100, img_width=500, img_height=1040),
+            Rectangle(100, 104, 200, 312)
+        )
+
+    def test_pdf_boxes_to_image_boxes(self):
+        """Batch conversion agrees with converting the boxes one by one."""
+        boxes = np.array([[10, 10, 20, 30], [0, 0, 50, 100], [1.5, 2.5, 3.5, 4.5]])
+        converted = converter.pdf_boxes_to_image_boxes(
+            boxes, pdf_width=50, pdf_height=100, img_width=500, img_height=1040)
+        self.assertEqual(converted.shape, (3, 4))
+        for box, image_box in zip(boxes, converted):
+            expected = converter.pdf_box_to_image_box(
+                Rectangle(*box), pdf_width=50, pdf_height=100, img_width=500, img_height=1040)
+            self.assertEqual(Rectangle(*image_box, dtype=int), expected)
+
+        self.assertRaises(
+            converter.RotatedPdfException,
+            converter.pdf_boxes_to_image_boxes,
+            boxes, pdf_width=50, pdf_height=100, img_width=1000, img_height=500)
+
     def test_images_to_pdf(self):
         """Create pdf from images and back to images and check consistency.
 
@@ -57,16 +116,58 @@ class TestRectangle(unittest.TestCase):
         image_reconstructed = converter.image_from_pdf_page(temporary_pdf_path, page_num=0, dpi=72, return_numpy=True)
 
         # 72 dpi should create image of unchanged size
-        self.assertEqual(image_reconstructed.shape, np.array(im1).shape)
+        self.assertEqual(image_reconstructed.shape, reference_image(FIRST_PDF_PAGE_PATH).shape)
 
         # the reconstructed image should have high similarity with the first page
-        self.assertGreater(naive_image_similarity(image_reconstructed, np.array(im1)), 0.95)
+        self.assertGreater(naive_image_similarity(image_reconstructed, FIRST_PDF_PAGE_PATH), 0.95)
 
         # the reconstructed image should have low similarity with the second page
-        self.assertLess(naive_image_similarity(image_reconstructed, np.array(im2)), 0.3)
+        self.assertLess(naive_image_similarity(image_reconstructed, SECOND_PDF_PAGE_PATH), 0.3)
+
+        os.remove(temporary_pdf_path)
+
+    def test_pdf_to_image_affine(self):
+        """Boxes mapped by the affine map agree with scaling, also in rotated images, and map back by the inverse."""
+        boxes = np.array([[10, 20, 110, 40], [300, 500, 350, 700]])
+        affine = converter.pdf_to_image_affine(595, 842, dpi=144)
+        np.testing.assert_allclose(converter.transform_boxes(boxes, affine), boxes * 2)
+        np.testing.assert_allclose(converter.transform_boxes(converter.transform_boxes(boxes, affine),
+                                                             np.linalg.inv(affine)), boxes)
+
+        # the rotated image has width 2 * 842 and height 2 * 595, the left edge of the page goes to the bottom
+        rotated = converter.transform_boxes(boxes, converter.pdf_to_image_affine(595, 842, dpi=144, rotate_by=90))
+        np.testing.assert_allclose(rotated[0], [40, 2 * 595 - 220, 80, 2 * 595 - 20])
+        # four quarter turns map boxes back where they were
+        np.testing.assert_allclose(converter.pdf_to_image_affine(595, 842, rotate_by=360),
+                                   converter.pdf_to_image_affine(595, 842))
+
+    def test_merge_pdf_contents(self):
+        """Merge pdfs given as bytes, the pages should follow the order of inputs."""
+        with open(PDF_PATH, "rb") as f:
+            content = f.read()
+        _, temporary_pdf_path = mkstemp()
+        converter.merge_pdf_contents(temporary_pdf_path, content, content)
+
+        merged = PdfFileReader(temporary_pdf_path)
+        self.assertEqual(merged.getNumPages(), 4)
+        self.assertEqual(merged.getPage(0).extractText(), merged.getPage(2).extractText())
+        self.assertEqual(merged.getPage(1).extractText(), PdfFileReader(str(PDF_PATH)).getPage(1).extractText())
 
         os.remove(temporary_pdf_path)
 
+    def test_merge_pdfs(self):
+        """Merge pdfs given by paths, with pikepdf (if installed) and with PyPDF2."""
+        _, temporary_pdf_path = mkstemp()
+        for pikepdf in (converter.pikepdf, None):
+            with self.subTest(pikepdf=pikepdf is not None), patch.object(converter, "pikepdf", pikepdf):
+                converter.merge_pdfs(temporary_pdf_path, PDF_ROTATED_PATH, PDF_PATH)
+                with open(temporary_pdf_path, "rb") as f:
+                    merged = PdfFileReader(f)
+                    self.assertEqual(merged.getNumPages(), 3)
+                    self.assertEqual(
+                        merged.getPage(2).extractText(), PdfFileReader(str(PDF_PATH)).getPage(1).extractText())
+        os.remove(temporary_pdf_path)
+
     def test_indices_of_words(self):
         """Test conversion of a text-span into indices of words that are fully or partially within the span."""
         words = [
@@ -78,5 +179,16 @@ class TestRectangle(unittest.TestCase):
         matched_words = converter.get_indices_of_words(words, span)
 
         # 'about' and 'the' are fully matched, 'friendly-looking' is partially matched
-        self.assertTrue(matched_words["full_words"], [5, 6])
-        self.assertTrue(matched_words["partial_words"], [7])
+        self.assertEqual(matched_words["full_words"], [5, 6])
+        self.assertEqual(matched_words["partial_words"], [7])
+
+        # an empty list of words matches nothing
+        self.assertEqual(converter.get_indices_of_words([], (0, 5)), {"full_words": [], "partial_words": []})
+
+        # many spans within the same words give the same results as the spans one by one
+        text = ' '.join(words)
+        spans = [match.span() for match in re.finditer(r"\w+ing|a\b|dog", text)]
+        self.assertEqual(
+            converter.get_indices_of_words_for_spans(words, spans),
+            [converter.get_indices_of_words(words, span) for span in spans])
+        self.assertEqual(converter.get_indices_of_words_for_spans(words, []), [])
@@ -1,21 +1,33 @@
+import base64
 import os
 import re
 import unittest
-from tempfile import mkstemp
+from io import BytesIO
+from tempfile import TemporaryDirectory, mkstemp
+from unittest.mock import MagicMock, patch
 
+from PIL import Image
+from PyPDF2 import PdfFileReader
+from lxml import etree
+
+from pdf_utils import ocr
 from pdf_utils.ocr import Scanner
 from pdf_utils.pdf_handler import Pdf
 from tests import PDF_PATH
 
+WORD_WITH_TEXT_XPATH = etree.XPath(".//word[text()=$text]")
+
 
 class TestScanner(unittest.TestCase):
 
-    example_pdf = Pdf(PDF_PATH)
-    first_page_large = example_pdf.page_image(page_idx=0, dpi=300)
-    ocr_data = None
+    factories_pattern = re.compile(r"of\s+all\s+factories\s+10\s+bil\.\s+Euro\s+4\%")
 
-    def setUp(self) -> None:
-        self.ocr_data = Scanner.ocr_one_image(self.first_page_large)
+    @classmethod
+    def setUpClass(cls) -> None:
+        # rendered and ocred once for all tests (which only read them), not when the module is imported
+        cls.example_pdf = Pdf(PDF_PATH)
+        cls.first_page_large = cls.example_pdf.page_image(page_idx=0, dpi=300)
+        cls.ocr_data = Scanner.ocr_one_image(cls.first_page_large)
 
     def test_image_ocr(self):
         """Test that correct words are ocred and that the word 'iruri' is on approximately proper position."""
@@ -29,7 +41,7 @@ class TestScanner(unittest.TestCase):
         self.assertTrue(iou > 0.9)
 
         # further, let's find the word 'irure' in both digital content and scanned content
-        irure_el = self.example_pdf.get_page_as_html(0).xpath('.//word[text()="irure"]')[0]
+        irure_el = WORD_WITH_TEXT_XPATH(self.example_pdf.get_page_as_html(0), text="irure")[0]
         irure_digital_bb = Pdf.get_bounding_box_of_elem(irure_el).relative_to_size(
             width=self.example_pdf.get_width_height(0)[0],
             height=self.example_pdf.get_width_height(0)[1]
@@ -41,6 +53,40 @@ class TestScanner(unittest.TestCase):
         # than the digital ones. So let's require intersection over union at least 0.4.
         self.assertGreater(irure_ocred_bb.get_iou(irure_digital_bb), 0.4)
 
+    @unittest.skipIf(ocr.tesserocr is None, "tesserocr is not installed")
+    def test_image_ocr_in_process(self):
+        """Ocr by tesserocr gives the same words as ocr by the tesseract binary."""
+        with patch.object(ocr, "tesserocr", None):
+            ocr_data_pytesseract = Scanner.ocr_one_image(self.first_page_large)
+        self.assertListEqual([item["word"] for item in self.ocr_data],
+                             [item["word"] for item in ocr_data_pytesseract])
+
+    def test_in_process_ocr_input(self):
+        """Raw pixels are handed over to libtesseract together with the resolution of the rendered page."""
+        api = MagicMock()
+        api.GetIterator.return_value = None  # nothing recognized
+        Scanner._tesserocr_data(api, self.first_page_large)
+
+        width, height = self.first_page_large.size
+        api.SetImageBytes.assert_called_once_with(self.first_page_large.tobytes(), width, height, 3, width * 3)
+        api.SetSourceResolution.assert_called_once_with(300)
+
+    def test_ocr_many_images(self):
+        """Ocr-ing a batch of images with one tesseract call should give the same words as ocr-ing them one by one."""
+        ocr_many = Scanner.ocr_many_images([self.first_page_large, self.first_page_large])
+
+        self.assertEqual(len(ocr_many), 2)
+        for ocr_data in ocr_many:
+            self.assertListEqual([item["word"] for item in ocr_data], [item["word"] for item in self.ocr_data])
+
+    def test_ocr_images_parallel(self):
+        """Concurrent ocr should return results in the order of input images."""
+        ocr_parallel = Scanner.ocr_images_parallel([self.first_page_large, self.first_page_large], max_workers=2)
+
+        self.assertEqual(len(ocr_parallel), 2)
+        for ocr_data in ocr_parallel:
+            self.assertListEqual([item["word"] for item in ocr_data], [item["word"] for item in self.ocr_data])
+
     def test_ocred_pdf(self):
         """Convert the example_pdf into an image and the image back into a one-page pdf: test consistency."""
         pdf_path = mkstemp()[1]
@@ -54,7 +100,90 @@ class TestScanner(unittest.TestCase):
         # get digital content of the scanned pdf
         scanned_text = scanned_pdf.layout_text
         self.assertTrue(
-            re.search(r"of\s+all\s+factories\s+10\s+bil\.\s+Euro\s+4\%", scanned_text)
+            self.factories_pattern.search(scanned_text)
         )
         # cleanup
         os.remove(pdf_path)
+
+    def test_images_to_ocred_pdf(self):
+        """Pages ocr-ed in worker processes are merged into one searchable pdf, in the order of images."""
+        pdf_path = mkstemp(suffix=".pdf")[1]
+        first_page_small = self.example_pdf.page_image(page_idx=0, dpi=150, recompute=True)
+        pdf_size = self.example_pdf.get_width_height(0)
+        Scanner.images_to_ocred_pdf([first_page_small, first_page_small], pdf_path, [pdf_size, pdf_size],
+                                    images_for_ocr=[self.first_page_large, self.first_page_large], max_workers=2)
+        scanned_pdf = Pdf(pdf_path)
+        self.assertEqual(scanned_pdf.number_of_pages, 2)
+        for page_idx in range(2):
+            self.assertIn("irure", scanned_pdf.get_pages_as_text()[page_idx])
+        # cleanup
+        os.remove(pdf_path)
+
+
+class TestOnePagePdf(unittest.TestCase):
+    """How page images are embedded into ocr-ed pdfs; no ocr is needed, the pdfs are created without text."""
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.example_pdf = Pdf(PDF_PATH)
+        cls.first_page = cls.example_pdf.page_image(page_idx=0)
+
+    def _one_page_pdf(self, im, **kwargs) -> bytes:
+        """Create one-page pdf with the image and no text, return its content."""
+        pdf_page = BytesIO()
+        pdf_width, pdf_height = self.example_pdf.get_width_height(0)
+        Scanner.image_to_one_page_ocred_pdf(im, pdf_page, pdf_width=pdf_width, pdf_height=pdf_height, ocr_text=[],
+                                            **kwargs)
+        return pdf_page.getvalue()
+
+    def assert_jpeg_page(self, pdf_content: bytes, image_size) -> bytes:
+        """Check that the pdf has one page of the size of the example pdf, showing one jpeg image of given size.
+
+        :return: the embedded jpeg data
+        """
+        reader = PdfFileReader(BytesIO(pdf_content))
+        self.assertEqual(reader.getNumPages(), 1)
+        page = reader.getPage(0)
+        self.assertEqual((int(page.mediaBox.getWidth()), int(page.mediaBox.getHeight())),
+                         self.example_pdf.get_width_height(0))
+        images = [xobject.getObject() for xobject in page["/Resources"]["/XObject"].values()]
+        self.assertEqual(len(images), 1)
+        self.assertIn("/DCTDecode", images[0]["/Filter"])
+        self.assertEqual((images[0]["/Width"], images[0]["/Height"]), image_size)
+        data = images[0]._data  # PyPDF2 cannot decode jpeg streams, reportlab encodes them by ascii85 only
+        if "/ASCII85Decode" in images[0]["/Filter"]:
+            data = base64.a85decode(data.rstrip()[:-len(b"~>")], ignorechars=b" \t\n\r\v")
+        return data
+
+    def test_jpeg_quality(self):
+        """With jpeg_quality, the page image is embedded as a jpeg of that quality."""
+        pdf_high_quality = self._one_page_pdf(self.first_page, jpeg_quality=90)
+        pdf_low_quality = self._one_page_pdf(self.first_page, jpeg_quality=30)
+
+        self.assert_jpeg_page(pdf_high_quality, self.first_page.size)
+        self.assert_jpeg_page(pdf_low_quality, self.first_page.size)
+        self.assertLess(len(pdf_low_quality), len(pdf_high_quality))
+
+    def test_embed_jpeg_file(self):
+        """An image opened from a jpeg file is embedded as stored, only if asked for and if it was not resized."""
+        with TemporaryDirectory() as temp_dir:
+            jpeg_path = os.path.join(temp_dir, "page.jpg")
+            self.first_page.save(jpeg_path, quality=50)
+            with open(jpeg_path, "rb") as f:
+                jpeg_content = f.read()
+
+            with Image.open(jpeg_path) as im:
+                pdf_content = self._one_page_pdf(im, embed_jpeg_file=True)
+            self.assertEqual(self.assert_jpeg_page(pdf_content, self.first_page.size), jpeg_content)
+
+            # not asked for, the jpeg_quality is applied
+            with Image.open(jpeg_path) as im:
+                pdf_content = self._one_page_pdf(im, jpeg_quality=90)
+            self.assertNotEqual(self.assert_jpeg_page(pdf_content, self.first_page.size), jpeg_content)
+
+            # modified in place, the image keeps its format, but the file is not embedded
+            with Image.open(jpeg_path) as im:
+                im.thumbnail((600, 600))
+                self.assertEqual(im.format, "JPEG")
+                pdf_content = self._one_page_pdf(im, jpeg_quality=90, embed_jpeg_file=True)
+            self.assertNotEqual(self.assert_jpeg_page(pdf_content, im.size), jpeg_content)
@@ -1,22 +1,39 @@
 import os
 import re
 import unittest
-from tempfile import mkstemp
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory, mkstemp
+from unittest.mock import patch
 
 import numpy as np
-from PIL import Image
+from lxml import etree, html
 
+from pdf_utils import pdf_handler
+from pdf_utils.converter import images_from_pdf, transform_boxes
 from pdf_utils.ocr import Scanner
-from pdf_utils.pdf_handler import Pdf
+from pdf_utils.pdf_handler import CannotReadPdf, Pdf, WORDS_XPATH
 from pdf_utils.rectangle import Rectangle
-from tests import FIRST_PDF_PAGE_PATH, PDF_PATH, PDF_ROTATED_PATH
-from tests.object_similarity import naive_image_similarity
+from tests import FIRST_PDF_PAGE_PATH, MEMORY_TMP_DIR, PDF_PATH, PDF_ROTATED_PATH
+from tests.object_similarity import images_are_equal, naive_image_similarity
+
+WORD_WITH_TEXT_XPATH = etree.XPath(".//word[text()=$text]")
 
 
 class TestPdf(unittest.TestCase):
 
-    pdf = Pdf(PDF_PATH)
-    pdf_rotated = Pdf(PDF_ROTATED_PATH)
+    stolen_bike_pattern = re.compile(r"Stolen\s+bike\s+500\s+Euro\s+3%")
+    email_at_line_end_pattern = re.compile(r"impuls@faktor.net\s*\n")
+    words_on_first_page = frozenset({"Lorem", "ipsum", "Aron", "killed", "pf@kendaxa.com"})
+    words_not_on_first_page = frozenset({"Autobahn", "Das", "The", "name", "hungry", "kendaxa@kendaxa.com"})
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        # opened when the tests run, not when the module is imported
+        cls.pdf = Pdf(PDF_PATH)
+        cls.pdf_rotated = Pdf(PDF_ROTATED_PATH)
+        # page images are cached on the shared pdfs; pdftoppm runs in subprocesses, both pdfs are rendered concurrently
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(Pdf.all_images, (cls.pdf, cls.pdf_rotated)))
 
     def test_basic_attributes(self):
         """Check correctness of path, name and number of pages."""
@@ -42,33 +59,132 @@ class TestPdf(unittest.TestCase):
         self.assertEqual(self.pdf.page_rotation(1), 0)
         self.assertEqual(self.pdf_rotated.page_rotation(0), 90)
 
+    def test_pdf_file_opened_on_demand(self):
+        """The pdf file is not kept open by an unused Pdf object, and it is opened again when needed."""
+        pdf = Pdf(PDF_PATH)
+        self.assertIsNone(pdf.pdf_file)
+        self.assertEqual(pdf.number_of_pages, 2)
+        self.assertIsNone(pdf.pdf_file)
+
+        self.assertEqual(pdf.get_width_height(1), self.pdf.get_width_height(1))
+        self.assertIsNone(pdf.pdf_file)
+
+        with pdf:
+            self.assertIs(pdf.pdf_reader, pdf.pdf_reader)
+            pdf_file = pdf.pdf_file
+            self.assertFalse(pdf_file.closed)
+        self.assertTrue(pdf_file.closed)
+        self.assertIsNone(pdf.pdf_file)
+
+    def test_unreadable_page_size_fails_lazily(self):
+        """A page whose size cannot be read does not prevent opening the pdf, asking for its size fails."""
+        with patch.object(Pdf, "_page_size", side_effect=CannotReadPdf("cannot read pdf width / height")):
+            pdf = Pdf(PDF_PATH)
+        self.assertEqual(pdf.number_of_pages, 2)
+        self.assertEqual(pdf.page_rotation(0), 0)
+        with self.assertRaises(CannotReadPdf):
+            pdf.get_width_height(0)
+
+    def test_pdf_to_image_affine(self):
+        """Word boxes mapped by the cached affine map lie within the rendered page image."""
+        affine = self.pdf.pdf_to_image_affine(0, dpi=150)
+        self.assertIs(self.pdf.pdf_to_image_affine(0, dpi=150), affine)
+        _, boxes = self.pdf.get_page_word_boxes(0)
+        image_boxes = transform_boxes(boxes, affine)
+        img_width, img_height = self.pdf.page_image(0, dpi=150).size
+        self.assertTrue(np.all(image_boxes >= 0))
+        self.assertTrue(np.all(image_boxes[:, [0, 2]] <= img_width) and np.all(image_boxes[:, [1, 3]] <= img_height))
+        np.testing.assert_allclose(image_boxes, self.pdf.get_page_word_boxes(0, (img_width, img_height))[1], atol=1.5)
+
+    def test_width_height_cached(self):
+        """Page sizes and rotations are read when the pdf is opened, and the file is closed afterwards."""
+        pdf = Pdf(PDF_ROTATED_PATH)
+        self.assertIsNone(pdf.pdf_file)
+        with patch("pdf_utils.pdf_handler.PdfFileReader") as reader:
+            for _ in range(3):
+                self.assertEqual(pdf.get_width_height(0), self.pdf_rotated.get_width_height(0))
+                self.assertEqual(pdf.page_rotation(0), 90)
+        reader.assert_not_called()
+        self.assertIsNone(pdf.pdf_file)
+
     def test_page_image(self):
         """Check consistency of first-page image, reference image, and recovered image from rotated pdf."""
         im_1 = self.pdf.page_image(0)
         im_rot_1 = self.pdf_rotated.page_image(0)
 
-        im_1_reconstructed = im_rot_1.rotate(90, expand=True)
+        # counter-clockwise quarter turn as a view of the pixels, no resampling (same as rotate(90, expand=True))
+        array_1_reconstructed = np.rot90(np.asarray(im_rot_1))
 
         # sizes should coincide
-        self.assertEqual(im_1.size, im_1_reconstructed.size)
+        array_1 = np.asarray(im_1)  # decoded once for both comparisons
+        self.assertEqual(array_1.shape, array_1_reconstructed.shape)
         # first pdf page should be similar to the rotated first page of rotated pdf
         self.assertGreater(
-            naive_image_similarity(np.array(im_1), np.array(im_1_reconstructed)), 0.98
+            naive_image_similarity(array_1, array_1_reconstructed), 0.98
         )
         # first page should be similar to the precomputed image from disc
         self.assertGreater(
             naive_image_similarity(
-                np.array(im_1),
-                np.array(Image.open(str(FIRST_PDF_PAGE_PATH)))),
+                array_1,
+                FIRST_PDF_PAGE_PATH),
             0.98
         )
 
-        images = list(self.pdf.images)
-        images_rotated = list(self.pdf_rotated.images)
-
-        # the 'images' method should return the precomputed images from a buffer, so here we require exact match
-        self.assertEqual(im_1, images[0])
-        self.assertEqual(im_rot_1, images_rotated[0])
+        images = self.pdf.images
+        images_rotated = self.pdf_rotated.images
+
+        # the 'images' method should return the precomputed images from a buffer, so here we require the same objects
+        # (also cheaper than comparing the images, which compares all their bytes)
+        self.assertIs(images[0], im_1)
+        self.assertIs(images_rotated[0], im_rot_1)
+
+    @unittest.skipIf(pdf_handler.fitz is None, "PyMuPDF is not installed")
+    def test_page_image_with_fitz(self):
+        """Pages rendered by PyMuPDF share one opened document and agree with pdftoppm rendering."""
+        pdf = Pdf(PDF_PATH)
+        images = [pdf.page_image(page_idx, backend="pymupdf") for page_idx in range(pdf.number_of_pages)]
+        self.assertIs(pdf.fitz_document, pdf.fitz_document)
+        self.assertEqual(len({img.size for img in images}), 1)
+        self.assertGreater(naive_image_similarity(np.asarray(images[0]), np.asarray(self.pdf.page_image(0))), 0.95)
+
+        # internally rotated page is rendered as the end-user sees it, like pdftoppm does
+        im_rot = Pdf(PDF_ROTATED_PATH).page_image(0, backend="pymupdf")
+        self.assertLessEqual(abs(im_rot.size[0] - self.pdf_rotated.page_image(0).size[0]), 1)
+
+    def test_images_rendered_at_once(self):
+        """All pages should be rendered by one bulk call, not page by page."""
+        pdf = Pdf(PDF_PATH)
+        with patch("pdf_utils.pdf_handler.image_from_pdf_page") as render_one_page:
+            images = pdf.images
+        render_one_page.assert_not_called()
+        self.assertEqual(len(images), pdf.number_of_pages)
+        self.assertTrue(images_are_equal(images[1], self.pdf.page_image(1)))
+
+    def test_all_images_cached_per_dpi(self):
+        """All pages are rendered by one call per dpi, and the images are reused by `page_image`."""
+        pdf = Pdf(PDF_PATH)
+        with patch("pdf_utils.pdf_handler.images_from_pdf", wraps=images_from_pdf) as render_pages:
+            images = pdf.all_images(dpi=100)
+            self.assertIs(pdf.all_images(dpi=100), images)
+            self.assertEqual(render_pages.call_count, 1)
+            self.assertEqual(len(pdf.all_images(dpi=50)), pdf.number_of_pages)
+            self.assertEqual(render_pages.call_count, 2)
+        self.assertEqual(len(images), pdf.number_of_pages)
+        self.assertIs(pdf.page_image(1, dpi=100), images[1])
+
+    def test_iter_images(self):
+        """Pages are rendered in batches and not cached on the object."""
+        pdf = Pdf(PDF_PATH)
+        with patch("pdf_utils.pdf_handler.images_from_pdf", wraps=images_from_pdf) as render_pages:
+            images = list(pdf.iter_images(batch_size=1))
+        self.assertEqual(render_pages.call_count, pdf.number_of_pages)
+        self.assertEqual(len(images), pdf.number_of_pages)
+        self.assertTrue(images_are_equal(images[1], self.pdf.page_image(1)))
+        self.assertEqual(pdf._images, {})
+
+        # cached pages are reused
+        first_page = pdf.page_image(0)
+        self.assertIs(next(pdf.iter_images()), first_page)
 
     def test_text_extraction_from_pdf(self):
         """This is essentially testing pdftotext (probably coming from Poppler, of Xpdf)."""
@@ -87,15 +203,15 @@ class TestPdf(unittest.TestCase):
 
         # Test that first page contain expected words
         words_in_first_page = set(simple_pages[0].split())
-        self.assertTrue({"Lorem", "ipsum", "Aron", "killed", "pf@kendaxa.com"}.issubset(words_in_first_page))
-        self.assertFalse({"Autobahn", "Das", "The", "name", "hungry", "kendaxa@kendaxa.com"} & words_in_first_page)
+        self.assertTrue(self.words_on_first_page.issubset(words_in_first_page))
+        self.assertFalse(self.words_not_on_first_page & words_in_first_page)
 
         # this regex should be matched in a reasonably extracted layout-first-page-text
-        self.assertTrue(re.search(r"Stolen\s+bike\s+500\s+Euro\s+3%", layout_pages[0]))
-        self.assertTrue(re.search(r"impuls@faktor.net\s*\n", layout_pages[1]))
+        self.assertTrue(self.stolen_bike_pattern.search(layout_pages[0]))
+        self.assertTrue(self.email_at_line_end_pattern.search(layout_pages[1]))
 
         # Find bounding box of 'extreme' word on first page
-        extreme_element = root.xpath(".//word[text()='extreme']")[0]
+        extreme_element = WORD_WITH_TEXT_XPATH(root, text="extreme")[0]
         extreme_bb = Rectangle(
             x_min=extreme_element.attrib["xmin"],
             y_min=extreme_element.attrib["ymin"],
@@ -111,6 +227,68 @@ class TestPdf(unittest.TestCase):
                 y_max=590
             ))
 
+    def test_pdftotext_runs_once_per_flavour(self):
+        """Repeated text extractions with the same arguments should not run pdftotext again."""
+        pdf = Pdf(PDF_PATH)
+        with patch.object(Pdf, "_run_pdftotext", wraps=pdf._run_pdftotext) as run_pdftotext:
+            self.assertEqual(pdf.simple_text, pdf.extract_text_from_pdf())
+            pages = [WORDS_XPATH(pdf.get_page_as_html(0)), WORDS_XPATH(pdf.get_page_as_html(0))]
+            # bounding boxes of all pages come from a single run of pdftotext
+            second_page = WORDS_XPATH(pdf.get_page_as_html(1))
+        self.assertEqual(run_pdftotext.call_count, 2)
+        self.assertEqual([w.text for w in pages[0]], [w.text for w in pages[1]])
+
+        # the xml output is parsed from bytes, the text is decoded only when asked for
+        self.assertNotIn(("-bbox-layout", None), pdf._pdftotext_texts)
+        self.assertEqual(pdf.extract_text_from_pdf("-bbox-layout"), pdf.extract_bytes_from_pdf("-bbox-layout").decode())
+
+        # pages of the whole-document output agree with the single-page output of pdftotext
+        second_page_alone = WORDS_XPATH(html.fromstring(pdf.extract_text_from_pdf("-bbox-layout", page_idx=1)))
+        self.assertEqual([(w.text, w.attrib["xmin"]) for w in second_page],
+                         [(w.text, w.attrib["xmin"]) for w in second_page_alone])
+
+    def test_pages_parsed_once(self):
+        """Repeated calls of get_pages reuse the word elements of pages parsed before."""
+        pdf = Pdf(PDF_PATH)
+        with patch.object(Pdf, "get_page_as_html", wraps=pdf.get_page_as_html) as get_page_as_html:
+            pages = pdf.get_pages()
+            pages_again = pdf.get_pages()
+        self.assertEqual(get_page_as_html.call_count, pdf.number_of_pages)
+        for page_idx, words in pages.items():
+            self.assertIs(pages_again[page_idx], words)
+
+        # words as strings come from the same parsed pages, without running pdftotext once more
+        with patch.object(Pdf, "_run_pdftotext") as run_pdftotext:
+            pages_as_text = pdf.get_pages_as_text()
+        run_pdftotext.assert_not_called()
+        self.assertEqual(pages_as_text, {page_idx: [w.text for w in words] for page_idx, words in pages.items()})
+
+    def test_text_cache(self):
+        """With a cache folder, pdftotext output of the same content is reused, also by a new Pdf object."""
+        with TemporaryDirectory() as cache_dir, patch.object(Pdf, "text_cache_dir", cache_dir):
+            bbox_text = Pdf(PDF_PATH).extract_text_from_pdf("-bbox-layout", page_idx=1)
+            with patch.object(Pdf, "_run_pdftotext") as run_pdftotext:
+                cached_text = Pdf(PDF_PATH).extract_text_from_pdf("-bbox-layout", page_idx=1)
+            run_pdftotext.assert_not_called()
+        self.assertEqual(cached_text, bbox_text)
+        self.assertEqual(bbox_text, self.pdf.extract_text_from_pdf("-bbox-layout", page_idx=1))
+
+    def test_page_word_boxes(self):
+        """Words and boxes of a page as one array agree with the per-word elements."""
+        texts, boxes = self.pdf.get_page_word_boxes(0)
+        words = self.pdf.get_pages()[0]
+        self.assertEqual(texts, [w.text for w in words])
+        self.assertEqual(boxes.shape, (len(words), 4))
+        for word, box in zip(words, boxes):
+            bb = Pdf.get_bounding_box_of_elem(word)
+            np.testing.assert_allclose(box, [bb.x_min, bb.y_min, bb.x_max, bb.y_max], rtol=1e-6)
+
+        # in image coordinates, boxes are scaled by the image / pdf ratio
+        w, h = self.pdf.get_width_height(0)
+        _, image_boxes = self.pdf.get_page_word_boxes(0, img_size=(2 * w, 2 * h))
+        self.assertEqual(image_boxes.dtype, np.int32)
+        self.assertLessEqual(np.abs(image_boxes - 2 * boxes).max(), 1)
+
     def test_text_extraction_from_rotated_pdf(self):
         """Check that bounding box of a word in pdf is where it should be."""
         pages = self.pdf.get_pages()
@@ -136,6 +314,17 @@ class TestPdf(unittest.TestCase):
             self.pdf_rotated.get_bounding_box_of_elem(pages_rotated[0][0]) in (
                 Rectangle(x_min=712, y_min=70, x_max=750, y_max=162)))
 
+    def test_images_for_ocr_not_cached(self):
+        """Images of higher resolution, rendered for ocr only, are not kept on the object after recreating the pdf."""
+        pdf = Pdf(PDF_PATH)
+        with patch.object(Scanner, "images_to_ocred_pdf") as images_to_ocred_pdf:
+            pdf.recreate_digital_content("unused.pdf", higher_dpi_for_scan=200)
+        images, _, _ = images_to_ocred_pdf.call_args[0]
+        images_for_ocr = images_to_ocred_pdf.call_args[1]["images_for_ocr"]
+        self.assertEqual(len(images_for_ocr), pdf.number_of_pages)
+        self.assertAlmostEqual(images_for_ocr[0].size[0] / images[0].size[0], 200 / 150, places=2)
+        self.assertEqual(set(pdf._images_dpi_cache), {150})
+
     def test_pdf_recreation(self):
         """Test the method `recreate_digital_content`.
 
@@ -145,9 +334,16 @@ class TestPdf(unittest.TestCase):
             * textual content of first page is the same as ocr-result from first page-image.
         (Ocr itself is tested in the test_ocr module.)
         """
-        tmp_pdf_file = mkstemp()[1]
-        self.pdf.recreate_digital_content(
-            tmp_pdf_file, tesseract_lang='eng', tesseract_conf="")
+        fd, tmp_pdf_file = mkstemp(suffix=".pdf", dir=MEMORY_TMP_DIR)
+        os.close(fd)
+        self.addCleanup(os.remove, tmp_pdf_file)  # also when the test fails, the file would hold memory
+        # the original first page (150 dpi), used for ocr, sizes and similarity below
+        first_page = self.pdf.page_image(0, dpi=150)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # ocr of the original first page (compared with the recreated text below) runs while the pdf is recreated
+            scanned_first_page = executor.submit(Scanner.ocr_one_image, first_page, lang="eng", config="")
+            self.pdf.recreate_digital_content(
+                tmp_pdf_file, tesseract_lang='eng', tesseract_conf="")
         recreated = Pdf(tmp_pdf_file)
 
         # pdf should have two pages
@@ -157,19 +353,19 @@ class TestPdf(unittest.TestCase):
         pdf_widh, pdf_height = self.pdf.get_width_height(0)
         self.assertEqual(recreated.get_width_height(0), (pdf_widh, pdf_height))
 
-        im_width, im_height = self.pdf.page_image(0, dpi=150).size
+        im_width, im_height = first_page.size
         im_recreated = recreated.page_image(0, dpi=150)
 
         # first page image original and reconstructed (widht equal dpi) should have approximately the same size
         self.assertLess(abs(im_width - im_recreated.size[0]) / im_width, 0.05)
         self.assertLess(abs(im_height - im_recreated.size[1]) / im_height, 0.05)
 
-        # first page should be similar to the first reconstructed page (after resizing)
-        im_recreated = im_recreated.resize((im_width, im_height))
+        # first page should be similar to the first reconstructed page;
+        # both are downsampled to the same size by the similarity, there is no need to resize the recreated page first
         self.assertGreater(
             naive_image_similarity(
-                np.array(self.pdf.page_image(0)),
-                np.array(im_recreated)),
+                np.asarray(first_page),
+                np.asarray(im_recreated)),
             0.98
         )
 
@@ -181,10 +377,8 @@ class TestPdf(unittest.TestCase):
             item.text: Pdf.get_bounding_box_of_elem(item).relative_to_size(width=pdf_widh, height=pdf_height)
             for item in words_and_bounding_boxes}
 
-        scanned_words_and_bounding_boxes = Scanner.ocr_one_image(
-            self.pdf.page_image(0), lang="eng", config="")
         scanned_words_and_bounding_boxes = {
-            item["word"]: item["bb"] for item in scanned_words_and_bounding_boxes}
+            item["word"]: item["bb"] for item in scanned_first_page.result()}
 
         # both dictionaries should have the same keys
         self.assertEqual(set(scanned_words_and_bounding_boxes), set(words_and_bounding_boxes))
@@ -195,6 +389,3 @@ class TestPdf(unittest.TestCase):
                 words_and_bounding_boxes["left"]),
             0.4
         )
-
-        # cleanup
-        os.remove(tmp_pdf_file)
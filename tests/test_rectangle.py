@@ -1,12 +1,23 @@
+import pickle
 import unittest
+from unittest.mock import patch
 
 import numpy as np
 
+from pdf_utils import rectangle
 from pdf_utils.rectangle import Rectangle
 
 
 class TestRectangle(unittest.TestCase):
 
+    def test_slots(self):
+        """Rectangles store only their coordinates, without a per-instance __dict__."""
+        rect = Rectangle(0, 1, 2, 3)
+        self.assertFalse(hasattr(rect, "__dict__"))
+        with self.assertRaises(AttributeError):
+            rect.label = "word"
+        self.assertEqual(pickle.loads(pickle.dumps(rect)), rect)
+
     def test_width_height(self):
         example_rect = Rectangle(x_min=0, y_min=1, x_max=2, y_max=33)
         self.assertEqual(example_rect.width, 2)
@@ -14,6 +25,11 @@ class TestRectangle(unittest.TestCase):
         self.assertEqual(example_rect.area, 64)
         self.assertEqual(example_rect.center, (1, 17))
 
+        # derived values follow reassigned coordinates
+        example_rect.x_max = 4
+        self.assertEqual(example_rect.width, 4)
+        self.assertEqual(example_rect.area, 128)
+
     def test_io(self):
         example_rect = Rectangle(x_min=0, y_min=1, x_max=2, y_max=33)
         self.assertEqual(
@@ -34,6 +50,15 @@ class TestRectangle(unittest.TestCase):
             Rectangle.from_coco(**dict(x_center=1, y_center=17, width=2, height=32))
         )
 
+        # many rectangles at once
+        rectangles = [example_rect, Rectangle(0.123, 4.567, 8.9, 10.111), Rectangle(-3, -2, -1, 0)]
+        for rounding in (2, None):
+            coco = Rectangle.to_coco_batch(Rectangle.boxes_to_array(rectangles), rounding=rounding)
+            self.assertEqual(coco.shape, (len(rectangles), 4))
+            for rect, row in zip(rectangles, coco):
+                np.testing.assert_allclose(
+                    row, [rect.to_coco(rounding)[key] for key in ("x_center", "y_center", "width", "height")])
+
     def test_image2box(self):
         h, w = 123, 234
         black_image = np.zeros((h, w))
@@ -60,6 +85,11 @@ class TestRectangle(unittest.TestCase):
         self.assertFalse(large in medium1)
         self.assertFalse(large in medium2)
 
+        # the same with arrays of boxes
+        self.assertTrue(medium1.contains_any(Rectangle.boxes_to_array([large, small])))
+        self.assertFalse(small.contains_any(Rectangle.boxes_to_array([medium1, medium2, large])))
+        self.assertFalse(large.contains_any(np.empty((0, 4))))
+
     def test_resizing_methods(self):
         example_rect = Rectangle(0.0, 1.5, 2.0, 33.3)
         self.assertEqual(
@@ -96,9 +126,64 @@ class TestRectangle(unittest.TestCase):
         self.assertEqual(r1.get_iou(r3), 1 / 9)
         self.assertEqual(r3.get_iou(r1), 1 / 9)
 
+        # boxes touching along an edge, and empty boxes, have zero iou
+        self.assertEqual(r1.get_iou(Rectangle(2, 1, 4, 3)), 0)
+        self.assertEqual(Rectangle(1, 1, 1, 3).get_iou(Rectangle(1, 2, 1, 4)), 0)
+
+        # boxes overlapping in one direction only
+        r4, r5 = Rectangle(0, 5, 3, 6), Rectangle(5, 0, 6, 3)
+        for r in (r4, r5):
+            self.assertIsNone(r1.intersection(r))
+            self.assertEqual(r1.get_iou(r), 0)
+
         self.assertTrue(r1.intersection_width_some_other([r2, r3]))
         self.assertFalse(r2.intersection_width_some_other([r1, r3]))
 
+        # the same with arrays of boxes
+        self.assertTrue(r1.any_intersects(Rectangle.boxes_to_array([r2, r3])))
+        self.assertFalse(r2.any_intersects(Rectangle.boxes_to_array([r1, r3])))
+        self.assertTrue(r2.any_intersects(Rectangle.boxes_to_array([Rectangle(0, 0, 1, 1)])))  # touching corner
+        self.assertFalse(r1.any_intersects(np.empty((0, 4))))
+
+    def test_iou_matrix(self):
+        """Ious of all pairs at once agree with ious of pairs one by one."""
+        rectangles = [Rectangle(0, 0, 3, 3), Rectangle(5, 5, 6, 6), Rectangle(1, 1, 2, 3), Rectangle(3, 0, 4, 1),
+                      Rectangle(2, 2, 2, 5)]
+        others = rectangles[1:4] + [Rectangle(0.5, 0.5, 5.5, 5.5)]
+        boxes = Rectangle.boxes_to_array(rectangles)
+        np.testing.assert_array_equal(boxes[2], [1, 1, 2, 3])
+        np.testing.assert_array_equal(boxes[3], rectangles[3].as_array)
+        self.assertEqual(Rectangle.boxes_to_array([]).shape, (0, 4))
+
+        ious = Rectangle.iou_matrix(boxes, Rectangle.boxes_to_array(others))
+        self.assertEqual(ious.shape, (len(rectangles), len(others)))
+        for i, rect in enumerate(rectangles):
+            for j, other in enumerate(others):
+                self.assertAlmostEqual(ious[i, j], rect.get_iou(other))
+        self.assertEqual(Rectangle.iou_matrix(boxes, np.empty((0, 4))).shape, (len(rectangles), 0))
+
+        # single precision stays single precision, integers are promoted
+        boxes32 = Rectangle.boxes_to_array(rectangles, dtype=np.float32)
+        ious32 = Rectangle.iou_matrix(boxes32, Rectangle.boxes_to_array(others, dtype=np.float32))
+        self.assertEqual(ious32.dtype, np.float32)
+        np.testing.assert_allclose(ious32, ious, rtol=1e-6)
+        self.assertEqual(Rectangle.iou_matrix(boxes.astype(int), boxes32).dtype, np.float64)
+
+    def test_internal_constructors_skip_checks(self):
+        """Rectangles built from coordinates of other rectangles are not checked again, public ones are."""
+        r1, r2 = Rectangle(0, 1, 2, 3), Rectangle(1, 0, 5, 2)
+        with patch.object(rectangle.logger, "warning") as warning:
+            self.assertEqual(r1.intersection(r2), Rectangle(1, 1, 2, 2))
+            self.assertEqual(r1.smallest_common_superrectangle(r2), Rectangle(0, 0, 5, 3))
+            rect_int = Rectangle(-0.5, 0.5, 1.7, 2.2).to_int()
+            self.assertEqual(rect_int.as_dict, dict(x_min=0, y_min=0, x_max=1, y_max=2))
+            self.assertTrue(all(isinstance(coordinate, int) for coordinate in rect_int.as_dict.values()))
+            warning.assert_not_called()
+            Rectangle(2, 0, 1, 1)
+            warning.assert_called_once()
+        self.assertIsInstance(r1.intersection(r2), Rectangle)
+        self.assertFalse(hasattr(r1.intersection(r2), "__dict__"))
+
     def test_smallest_common_superrectangle(self):
         r1, r2 = Rectangle(0, 0, 1, 1), Rectangle(10, 10, 11, 11)
         self.assertEqual(
@@ -124,3 +209,13 @@ class TestRectangle(unittest.TestCase):
         self.assertTrue(any([
             normalization == [expected_normalization_1, expected_normalization_2],
             normalization == [expected_normalization_2, expected_normalization_1]]))
+
+        # groups are merged until the superrectangles are disjoint, also when a superrectangle grows into another
+        growing = Rectangle.normalize_list_of_rectangles(
+            [Rectangle(0, 0, 2, 2), Rectangle(4, 0, 6, 2), Rectangle(1, 1, 5, 3), Rectangle(3, 2.5, 7, 7)])
+        self.assertEqual(growing, [Rectangle(0, 0, 7, 7)])
+
+        # long chains of intersecting rectangles are merged without recursion
+        chain = [Rectangle(i, 0, i + 1.5, 1) for i in range(1500)] + [Rectangle(0, 10, 1, 11)]
+        self.assertEqual(Rectangle.normalize_list_of_rectangles(chain),
+                         [Rectangle(0, 0, 1500.5, 1), Rectangle(0, 10, 1, 11)])